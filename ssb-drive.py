@@ -24,6 +24,7 @@ logger.setLevel(logging.INFO)
 
 import ssb.adt.lfs
 import ssb.app.drive
+import ssb.app.gc
 import ssb.peer.session
 import ssb.local.config
 import ssb.local.worm
@@ -175,6 +176,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     sess = ssb.peer.session.SSB_SESSION(args.username)
+    ssb.app.gc.pin_own_drives(sess.worm)
 
     if args.sync:
         if args.port:
@@ -211,11 +213,10 @@ if __name__ == '__main__':
             sys.exit(0)
         if args.list:
             print("Available SSB drives:")
-            for ref in ssb.adt.lfs.find_lfs_root_iter(sess.worm):
-                m = sess.worm.readMsg(ref[1])
-                t = datetime.utcfromtimestamp(m['value']['timestamp']/1000)
-                u = ssb.adt.lfs.uuid_from_key(sess.worm, ref[1])
-                print("  uuid=%s  (%s)" % (u, str(t)[:19]))
+            for d in ssb.adt.lfs.lfs_drives(sess.worm).drives():
+                t = datetime.utcfromtimestamp(d['created']/1000)
+                print("  uuid=%s  (%s)" % (d['uuid'], str(t)[:19]))
+            sess.worm.flush()
             sys.exit(0)
         if args.new:
             fs = ssb.adt.lfs.SSB_LFS(sess.worm)
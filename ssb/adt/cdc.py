@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# ssb/adt/cdc.py
+# content-defined chunking of large files into blobs, plus a manifest blob
+
+import hashlib
+import json
+
+# ---------------------------------------------------------------------------
+
+"""
+
+A chunked file is stored as the blobs of its chunks and a manifest blob:
+
+  { 'type': 'ssb_lfs:v1:chunks',
+    'size': total size,
+    'chunks': [ [ '&..', size ], .. ] }
+
+Chunk boundaries depend on the content only (gear hash over the last 32
+bytes), so an edit only changes the chunks around it: the others keep
+their blob keys and need neither be stored nor replicated again.
+
+"""
+
+tag_chunks = 'ssb_lfs:v1:chunks'
+
+CDC_MIN  = 16*1024   # no cut before this chunk size
+CDC_MASK = 0xffff0000 # cut where these hash bits are zero: 64KiB on average
+CDC_MAX  = 256*1024  # always cut at this chunk size
+
+# 256 pseudo-random 32bit values, fixed for all peers
+_GEAR = [ int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big')
+                                                        for i in range(256) ]
+
+def _cdc_scan(buf, i, h):
+    # continue hashing buf at i, returns (cut or None, i, h)
+    end = min(len(buf), CDC_MAX)
+    i = max(i, CDC_MIN - 32) # only the last 32 bytes influence the mask bits
+    while i < end:
+        h = ((h << 1) + _GEAR[buf[i]]) & 0xffffffff
+        i += 1
+        if i >= CDC_MIN and not h & CDC_MASK:
+            return (i, i, h)
+    if end == CDC_MAX:
+        return (CDC_MAX, i, h)
+    return (None, i, h)
+
+def cdc_split(src):
+    # src is an iterator over byte strings, yields the chunks
+    buf = bytearray()
+    i = h = 0
+    for data in src:
+        buf += data
+        while True:
+            cut, i, h = _cdc_scan(buf, i, h)
+            if cut is None:
+                break
+            yield bytes(buf[:cut])
+            del buf[:cut]
+            i = h = 0
+    while len(buf) > 0:
+        cut, i, h = _cdc_scan(buf, i, h)
+        if cut is None:
+            cut = len(buf)
+        yield bytes(buf[:cut])
+        del buf[:cut]
+        i = h = 0
+
+def write_chunked(worm, src, chunkSize=65536):
+    # src is a binary file-like object, returns (manifest key, size)
+    chunks = []
+    size = 0
+    for data in cdc_split(iter(lambda: src.read(chunkSize), b'')):
+        chunks.append([worm.writeBlob(data), len(data)])
+        size += len(data)
+    manifest = { 'type': tag_chunks, 'size': size, 'chunks': chunks }
+    return (worm.writeBlob(json.dumps(manifest).encode('utf8')), size)
+
+def read_manifest(worm, key):
+    m = json.loads(worm.readBlob(key).decode('utf8'))
+    if type(m) != dict or m.get('type') != tag_chunks:
+        raise ValueError("not a chunk manifest")
+    return m
+
+def read_chunked(worm, key):
+    # iterate over the content of a chunked file
+    for k,_ in read_manifest(worm, key)['chunks']:
+        yield from worm.readBlobChunks(k)
+
+def missing_chunked(worm, key):
+    # blob keys still needed to reassemble the file
+    if not worm.blobAvailable(key):
+        return [key]
+    return [ k for k,_ in read_manifest(worm, key)['chunks']
+                                              if not worm.blobAvailable(k) ]
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__' :
+
+    import sys
+
+    with open(sys.argv[1], 'rb') as f:
+        sizes = [ len(c) for c in cdc_split(iter(lambda: f.read(65536), b'')) ]
+    print(len(sizes), "chunks,", sum(sizes), "bytes, max", max(sizes or [0]))
+
+# eof
@@ -10,6 +10,7 @@ import sys
 import uuid
 
 import ssb.adt.tangle
+import ssb.local.worm
 
 # ---------------------------------------------------------------------------
 
@@ -53,6 +54,7 @@ content INSIDE a tangle record for directory entries (dent):
 
 * bind name to file:
      { 'type': 'bindF', 'name': '..', 'size': xx, 'blobkey': '%..' }
+     with 'chunked': true if blobkey is a chunk manifest (ssb/adt/cdc.py)
 
 * bind name to subdirectory:
      { 'type': 'bindD', 'name': '..', 'dirref': [ '@..', '%..' ] }
@@ -64,15 +66,117 @@ content INSIDE a tangle record for directory entries (dent):
 * close (block) a drive:
      { 'type': 'blocked' }
 
+* snapshot of the live entries in the causal past of this record:
+     { 'type': 'snapshot', 'binds': [ ['@..', '%..'], ..], 'tombs': [ '%..' ] }
+     'tombs' lists unbound keys which were not part of that past. A
+     snapshot is only written by a peer which has all of that past, and
+     it links all tips: its past are all msgs of the dir the peer had
+
 
 not implemented yet:
 
 * record for symlink (bindL / 'name' / path)
 * record for mount, umount
-* directory snapshots
 
 """
 
+class SSB_LFS_DIRS(ssb.local.worm.SSB_WORM_JSONJOURNAL):
+
+    # flume/lfs_dirs.json: materialized OR-Set state of each directory
+    # tangle, base key -> {
+    #   'gen':   n  bumped on every change (for cache invalidation)
+    #   'binds': { key: [height, dent] }  live entries, dent with 'this'
+    #                                     and 'timestamp' of the bind msg
+    #   'tombs': { key: unbind_key }      removed entries
+    # }
+    # Tombstones are kept as unbind msgs can arrive before what they remove.
+    # A snapshot seeds the directory with its entries and tombstones, so
+    # that these do not depend on having the full history in the log.
+    # Changed directories are appended to lfs_dirs.json.jnl on flush.
+
+    def __init__(self, fname, readonly=False, worm=None):
+        super().__init__(fname, readonly=readonly)
+        self._worm = worm
+
+    def _bind(self, d, key, author, tan, ts):
+        dent = copy.copy(tan['content'])
+        dent['this'] = [author, key]
+        dent['timestamp'] = ts
+        d['binds'][key] = [tan.get('height', 0), dent]
+
+    def _seed(self, d, rec, c):
+        # returns True if the snapshot changed the state
+        changed = False
+        # the snapshot's past is complete and holds all of its author's
+        # earlier msgs: its earlier binds not listed were removed, even if
+        # we lack the unbind msg. Later ones can be here already, as bind
+        # msgs listed by snapshots are looked up in the whole log
+        listed = set([ r[1] for r in c.get('binds', []) ])
+        for k,e in list(d['binds'].items()):
+            if e[1]['this'][0] == rec.author and not k in listed and \
+               self._worm.readMsg(k)['value']['sequence'] < rec.sequence:
+                d['tombs'][k] = rec.key
+                del d['binds'][k]
+                changed = True
+        for k in c.get('tombs', []):
+            if k not in d['tombs']:
+                d['tombs'][k] = rec.key
+                d['binds'].pop(k, None)
+                changed = True
+        for r in c.get('binds', []):
+            if r[1] in d['binds'] or r[1] in d['tombs']:
+                continue
+            m = self._worm.readMsg(r[1])
+            if not m: # added once the bind msg arrives
+                continue
+            self._bind(d, r[1], r[0], m['value']['content'],
+                       m['value']['timestamp'])
+            changed = True
+        return changed
+
+    def add(self, offs, rec):
+        if rec.contentType != 'tangle':
+            return
+        tan = rec.msg['value']['content']
+        if not 'base' in tan or type(tan.get('content')) != dict:
+            return
+        base = tan['base'][1]
+        d = self.value.setdefault(base, { 'gen': 0, 'binds': {}, 'tombs': {} })
+        c = tan['content']
+        if c.get('type') == 'snapshot':
+            if not self._seed(d, rec, c):
+                return
+        elif c.get('type') == 'unbind':
+            d['tombs'][c['key']] = rec.key
+            d['binds'].pop(c['key'], None)
+        elif rec.key not in d['tombs']:
+            self._bind(d, rec.key, rec.author, tan,
+                       rec.msg['value']['timestamp'])
+        else:
+            return
+        d['gen'] += 1
+        self.touch(base)
+
+    def generation(self, base):
+        d = self.value.get(base)
+        return d['gen'] if d else 0
+
+    def entries(self, base):
+        # live dents of this dir, in tangle order (most recent first)
+        d = self.value.get(base)
+        if not d:
+            return []
+        lst = sorted(d['binds'].items(),
+                     key=lambda e: (ssb.adt.tangle._sortkey(e[0], e[1][0]),
+                                    e[0]))
+        return [ copy.copy(e[1][1]) for e in lst ]
+
+def lfs_dirs(worm):
+    return worm.attachIndex('lfs_dirs.json',
+                            lambda fn, readonly: SSB_LFS_DIRS(fn,
+                                                   readonly=readonly, worm=worm))
+
+
 class SSB_LFS:
 
     def __init__(self, worm, rootRef=None, owners=None):
@@ -84,17 +188,17 @@ class SSB_LFS:
         self._cwt  = self._root  # current working tangle
         self._pars = [self._cwt] # list of parent tangles
         self._path = ['']        # list of strings
+        self._dirs = {}  # (parent base, name) -> (dir generation, dirref)
 
     def uuid(self):
         return uuid_from_key(self._worm, self._root.base[1])
 
     def items(self): # iterate through cwd
         self._cwt.refresh()
-        return LFS_ITER(self._worm, self._cwt, None)
+        return iter(lfs_dirs(self._worm).entries(self._cwt.base[1]))
 
     def ls(self, dirref): # iterate through this dir tagle
-        dir = ssb.adt.tangle.SSB_TANGLE(self._worm, dirref)
-        return LFS_ITER(self._worm, dir, None)
+        return iter(lfs_dirs(self._worm).entries(dirref[1]))
 
     def getcwd(self): # get current working directory
         return '/' + '/'.join(self._path[1:])
@@ -102,6 +206,21 @@ class SSB_LFS:
     def close(self):
         self._root.append({ 'type': 'blocked' })
 
+    def _lookupDir(self, base, name):
+        # dirref of subdirectory name, cached until the parent changes
+        gen = lfs_dirs(self._worm).generation(base)
+        e = self._dirs.get((base, name))
+        if e and e[0] == gen:
+            return e[1]
+        for dent in lfs_dirs(self._worm).entries(base):
+            if dent.get('name') == name and dent['type'] == 'bindD':
+                ref = dent['dirref']
+                break
+        else:
+            ref = None
+        self._dirs[(base, name)] = (gen, ref)
+        return ref
+
     def cd(self, path): # change directory
         new_pars = copy.copy(self._pars)
         new_path = copy.copy(self._path)
@@ -121,18 +240,33 @@ class SSB_LFS:
                         new_path.pop()
                     new_cwt = new_pars[-1]
                 else:
-                    for dent in LFS_ITER(self._worm, new_cwt, None):
-                        if dent['name'] == p and dent['type'] == 'bindD':
-                            break
-                    else:
+                    ref = self._lookupDir(new_cwt.base[1], p)
+                    if not ref:
                         raise ValueError
-                    new_cwt = ssb.adt.tangle.SSB_TANGLE(self._worm, dent['dirref'])
+                    new_cwt = ssb.adt.tangle.SSB_TANGLE(self._worm, ref)
                     new_pars.append(new_cwt)
                     new_path.append(p)
         self._cwt = new_cwt
         self._pars = new_pars
         self._path = new_path
 
+    def snapshot(self):
+        # record the live state of the cwd, so that replays can stop here.
+        # Readers trust it for its whole causal past, and for all earlier
+        # msgs of its author: refused unless we have all msgs of this dir
+        # that we know of, and the record can link all tips
+        self._cwt.refresh()
+        if ssb.adt.tangle.tangle_tips(self._worm).missing(self._cwt.base[1]):
+            raise OSError("msgs of this directory are missing")
+        if len(self._cwt.tips) > 3:
+            raise OSError("too many concurrent branches")
+        binds, tombs = _lfs_replay(self._worm, self._cwt.tips)
+        return self._cwt.append({
+            'type': 'snapshot',
+            'binds': [ [m['value']['author'], k] for k,m in binds.items() ],
+            'tombs': list(tombs)
+        })
+
     def mkdir(self, n):
         # FIXME: refuse if target name exists
         dirtan = ssb.adt.tangle.SSB_TANGLE(self._worm,
@@ -150,9 +284,8 @@ class SSB_LFS:
             if dent['this'][1] == bindkey:
                 if dent['type'] != 'bindD':
                     raise OSError
-                dir = ssb.adt.tangle.SSB_TANGLE(self._worm, dent['dirref'])
-                for e in LFS_ITER(self._worm, dir, None): # must be empty
-                    raise OSError("directory not empty")
+                if lfs_dirs(self._worm).entries(dent['dirref'][1]):
+                    raise OSError("directory not empty") # must be empty
                 self._cwt.append({
                     'type': 'unbind',
                     'key': bindkey
@@ -160,14 +293,17 @@ class SSB_LFS:
                 return
         raise ValueError("no such directory entry")
 
-    def linkBlob(self, n, size, key, overwrite=False):
+    def linkBlob(self, n, size, key, overwrite=False, chunked=False):
         # FIXME: refuse if target name exists and is a dir
-        self._cwt.append({
+        dent = {
             'type': 'bindF',
             'name': n,
             'size': size,
             'blobkey' : key,
-        })
+        }
+        if chunked: # key is a chunk manifest, see ssb/adt/cdc.py
+            dent['chunked'] = True
+        self._cwt.append(dent)
         # FIXME: if overwrite: remove all files with the given name
 
     def unlinkBlob(self, bindkey):
@@ -195,39 +331,34 @@ class SSB_LFS:
     """
 
 
-class LFS_ITER:
-
-    def __init__(self, worm, tang, cwdRef):
-        # print("fs_iter")
-        self._worm = worm
-        self._tang = tang
-        # self._cwd = cwdRef
-        self._tomb = []
-        for k in tang:
-            dent = self._worm.readMsg(k)
-            if dent['value']['content']['content']['type'] == 'unbind':
-                # print('tombstone', k, dent['key'])
-                self._tomb.append(dent['value']['content']['content']['key'])
-        # print('tomb', [t[:10] for t in self._tomb])
-        self._iter = iter(tang)
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        while True:
-            k = self._iter.__next__()
-            # print(".. ", k)
-            if k in self._tomb:
-                continue
-            bind = self._worm.readMsg(k)
-            if bind['value']['content']['content']['type'] == 'unbind':
-                continue;
-            # print('ok to go:', k)
-            r = copy.copy(bind['value']['content']['content'])
-            r['this'] = [bind['value']['author'], bind['key']]
-            r['timestamp'] = bind['value']['timestamp']
-            return r
+def _is_snapshot(c):
+    return type(c) == dict and c.get('type') == 'snapshot'
+
+def _lfs_replay(worm, tips):
+    # replay a directory tangle from the given tips down to the most
+    # recent snapshot (and any branch concurrent to it). Returns the live
+    # bind msgs (key -> msg) and the unbound keys which matched none of them
+    it = ssb.adt.tangle.SSB_TANGLE_ITER(worm, tips, cut=_is_snapshot)
+    binds = {}
+    tombs = set()
+    for k in it:
+        m = worm.readMsg(k)
+        c = m['value']['content']['content']
+        if c['type'] == 'unbind':
+            tombs.add(c['key'])
+        elif k == it.cut:
+            for r in c['binds']:
+                b = worm.readMsg(r[1])
+                if b:
+                    binds[r[1]] = b
+            tombs.update(c.get('tombs', []))
+        elif c['type'] != 'snapshot': # other snapshots are not needed
+            binds[k] = m
+    for t in list(tombs):
+        if t in binds:
+            del binds[t]
+            tombs.remove(t)
+    return (binds, tombs)
 
 # ---------------------------------------------------------------------------
 
@@ -236,7 +367,7 @@ class LFS_ROOT_ITER:
     def __init__(self, worm):
         # print("lfs_root_iter for", worm._logFname)
         self._worm = worm
-        self._i = iter(worm)
+        self._i = worm.records()
         self._closed = []
         self._found = []
 
@@ -245,12 +376,11 @@ class LFS_ROOT_ITER:
 
     def __next__(self):
         while True:
-            k = self._i.__next__()
-            if k in self._closed:
-                continue
-            m = self._worm.readMsg(k)
-            if not m:
+            rec = self._i.__next__()
+            k = rec.key
+            if k in self._closed or rec.contentType != 'tangle':
                 continue
+            m = rec.msg
             c = m['value']['content']
             if type(c) == dict and c['type'] == 'tangle':
                 try:
@@ -266,6 +396,8 @@ class LFS_ROOT_ITER:
                 # fetch root node by folllowing the base ref
                 if 'base' in c:
                     k = c['base'][1]
+                    if k in self._closed:
+                        continue
                     m = self._worm.readMsg(k)
                     if not m:
                         continue
@@ -279,8 +411,76 @@ class LFS_ROOT_ITER:
                 return [m['value']['author'], m['key']]
         raise StopIteration
 
+class SSB_LFS_DRIVES(ssb.local.worm.SSB_WORM_JSONVIEW):
+
+    # flume/lfs_drives.json: registry of the drives in the log
+    #   'drives':  { uuid: { 'ref': [author, key], 'created': ts,
+    #                        'last': offs, 'blocked': bool } }
+    #   'roots':   { root key: uuid }
+    #   'pending': { base key: [offs, blocked] }  activity for bases not
+    #                                             seen yet (out of order)
+    # 'last' is the log position of the drive's most recent root tangle
+    # entry, 'blocked' is true if that entry is our own { 'type': 'blocked' }
+
+    def __init__(self, fname, readonly=False, worm=None):
+        super().__init__(fname, readonly=readonly)
+        self._worm = worm
+
+    def reset(self):
+        super().reset()
+        self.data['value'] = { 'drives': {}, 'roots': {}, 'pending': {} }
+
+    def add(self, offs, rec):
+        if rec.contentType != 'tangle':
+            return
+        v = self.value
+        c = rec.msg['value']['content']
+        if 'base' in c:
+            base = c['base'][1]
+            blocked = type(c.get('content')) == dict and \
+                      c['content'].get('type') == 'blocked' and \
+                      rec.author == self._worm.id
+            if base in v['roots']:
+                d = v['drives'][v['roots'][base]]
+                d['last'], d['blocked'] = offs, blocked
+            else:
+                pos = self._worm.offsetOf(base)
+                if pos is not None and pos < offs:
+                    return # some other tangle
+                v['pending'][base] = [offs, blocked]
+        else: # genesis
+            p = v['pending'].pop(rec.key, None)
+            if c.get('use') == tag_lfs_root:
+                u = str(uuid.uuid5(uuid.UUID(NS_UUID),
+                                   c.get('salt', '') + rec.key))
+                v['roots'][rec.key] = u
+                v['drives'][u] = {
+                    'ref': [rec.author, rec.key],
+                    'created': rec.msg['value']['timestamp'],
+                    'last': offs, # after any pending activity
+                    'blocked': p[1] if p else False
+                }
+            elif p is None:
+                return
+        self.touch()
+
+    def drives(self):
+        # open drives, most recently active first
+        lst = [ dict(d, uuid=u) for u,d in self.value['drives'].items()
+                                                       if not d['blocked'] ]
+        return sorted(lst, key=lambda d: d['last'], reverse=True)
+
+    def get(self, uuid):
+        d = self.value['drives'].get(uuid)
+        return d['ref'] if d and not d['blocked'] else None
+
+def lfs_drives(worm):
+    return worm.attachIndex('lfs_drives.json',
+                            lambda fn, readonly: SSB_LFS_DRIVES(fn,
+                                                   readonly=readonly, worm=worm))
+
 def find_lfs_root_iter(worm):
-    return LFS_ROOT_ITER(worm)
+    return iter([ d['ref'] for d in lfs_drives(worm).drives() ])
 
 def find_lfs_mostRecent(worm):
     # find our most recently defined FS in the log
@@ -290,10 +490,7 @@ def find_lfs_mostRecent(worm):
     return None
 
 def get_lfs_by_uuid(worm, uuid):
-    for ref in find_lfs_root_iter(worm):
-        if uuid == uuid_from_key(worm, ref[1]):
-            return ref
-    return None
+    return lfs_drives(worm).get(uuid)
 
 # ---------------------------------------------------------------------------
 if __name__ == '__main__' :
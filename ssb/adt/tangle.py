@@ -2,10 +2,73 @@
 
 # ssb/adt/tangle.py
 
-import copy
+import heapq
 
 import ssb.local.worm
 
+class SSB_TANGLE_TIPS(ssb.local.worm.SSB_WORM_JSONVIEW):
+
+    # flume/tangle_tips.json: tangle base key -> {
+    #   'tips':    [ [author, key, height], ... ]  in log order
+    #   'missing': [ key, ... ]  referenced by members, but not seen yet
+    # }
+    # Each tangle msg updates this in O(|previous|): msgs from different
+    # feeds arrive in any order, hence the list of missing references.
+    # Members are found from the tips along 'previous' (SSB_TANGLE_ITER),
+    # so this replaces the base -> members index of flume/tangles.json.
+
+    def __init__(self, fname, readonly=False, worm=None):
+        super().__init__(fname, readonly=readonly)
+        self._worm = worm
+
+    def add(self, offs, rec):
+        if rec.contentType != 'tangle':
+            return
+        tan = rec.msg['value']['content']
+        k = rec.key
+        if 'base' in tan:
+            base = tan['base'][1]
+            refs = [base] + [p[1] for p in tan.get('previous', [])]
+        else: # genesis
+            base = k
+            refs = []
+        e = self.value.setdefault(base, { 'tips': [], 'missing': [] })
+        for r in refs:
+            for t in e['tips']:
+                if t[1] == r:
+                    e['tips'].remove(t)
+                    break
+            else:
+                if r in e['missing']:
+                    continue
+                pos = self._worm.offsetOf(r)
+                if pos is None or pos >= offs: # not seen yet
+                    e['missing'].append(r)
+        if k in e['missing']: # already referenced, can't be a tip
+            e['missing'].remove(k)
+        else:
+            e['tips'].append( [rec.author, k, tan.get('height', 0)] )
+        self.touch()
+
+    def tips(self, base):
+        # returns (tips youngest first, max height of the tips)
+        e = self.value.get(base)
+        if not e or len(e['tips']) == 0:
+            return ([], 0)
+        tips = [ tuple(t) for t in reversed(e['tips']) ]
+        return (tips, max([t[2] for t in tips]))
+
+    def missing(self, base):
+        # keys referenced by members of this tangle which we don't have
+        e = self.value.get(base)
+        return list(e['missing']) if e else []
+
+def tangle_tips(worm):
+    return worm.attachIndex('tangle_tips.json',
+                            lambda fn, readonly: SSB_TANGLE_TIPS(fn,
+                                                   readonly=readonly, worm=worm))
+
+
 class SSB_TANGLE:
 
     def __init__(self, worm, baseName=None, use=None, salt=None, drv=None):
@@ -28,50 +91,7 @@ class SSB_TANGLE:
 
     def _getTips(self, stop=None):
         # print("searching", self.base[1])
-        # search the log backwards for any tangle msg for 'base'
-        allx = []
-        for k in self.worm:
-            if k == self.base[1]:
-                allx.append(k)
-                continue
-            msg = self.worm.readMsg(k)
-            if msg == None:
-                # print("no msg for", key)
-                continue
-            tan = msg['value']['content']
-            if not isinstance(tan,dict) or tan['type'] != 'tangle':
-                continue
-            if 'base' in tan:
-                # print(k, tan['base'])
-                if tan['base'][1] == self.base[1]:
-                    allx.append(k)
-        tips = copy.copy(allx)
-        for k in allx:
-            msg = self.worm.readMsg(k)
-            if msg == None:
-                # print("no msg for", key)
-                continue
-            tan = msg['value']['content']
-            if 'base' in tan and tan['base'][1] in tips:
-                tips.remove(tan['base'][1])
-            if 'previous' in tan:
-                for p in tan['previous']:
-                    if p[1] in tips:
-                        tips.remove(p[1])
-        maxH = 0
-        for k in tips:
-            msg = self.worm.readMsg(k)
-            h = msg['value']['content']['height']
-            if  h > maxH:
-                maxH = h
-        allx = tips
-        tips = []
-        for k in allx:
-            msg = self.worm.readMsg(k)
-            tan = msg['value']['content']
-            tips.append( (msg['value']['author'], k, tan['height']) )
-        # print(tips, maxH)
-        return (tips, maxH)
+        return tangle_tips(self.worm).tips(self.base[1])
 
     def getBaseRef(self):
         return self.base
@@ -93,11 +113,8 @@ class SSB_TANGLE:
         else:
             msg['previous'] = [previous] # only point to one branch
             msg['height'  ] = self.worm.readMsg(previous[1])['value']['content']['height'] + 1
-            previous = []
         ref = [self.worm.id, self.worm.writeMsg(msg)]
-        self.tips = self.tips[len(previous):]
-        self.tips.append(ref)
-        self.height += 1
+        self.tips, self.height = self._getTips() # updated by the append
         # print("  #tips now is", len(self.tips), "/ height", self.height)
         # for t in self.tips:
         #     print("    ", t[1])
@@ -112,36 +129,92 @@ class SSB_TANGLE:
         self.tips, self.height = self._getTips(self.tips)
 
 
+def _sortkey(key, height):
+    # integer equivalent of float("%d.%d" % (height, _hthash(key))), exact
+    # and without string formatting; negated for use with heapq (max first)
+    frac = int(str(ssb.local.worm._hthash(key)).ljust(10, '0'))
+    return -(height * 10**10 + frac)
+
+
 class SSB_TANGLE_ITER:
 
-    def __init__(self, worm, tips):
+    # Yields the member keys, highest (height, hash) first. If cut(content)
+    # is given, the first entry for which it is true (e.g. a snapshot) is
+    # yielded and its causal past is "covered": covered entries are only
+    # expanded while uncovered ones remain (concurrent branches), and are
+    # not yielded. Entries are popped after all their successors (heights
+    # increase along 'previous'), so coverage is known at pop time.
+    # Once an uncovered entry refers to a msg we lack, what lies below
+    # that msg is unknown: from then on, nothing is treated as covered.
+
+    def __init__(self, worm, tips, cut=None):
         self.worm = worm
-        self.front = [ (k[1], self.worm.readMsg(k[1])['value']['content'])
-                                      for k in tips ]
-        self.expanded = []
+        self.front = []      # heap of (sortkey, key, content)
+        self.seen = set()    # keys that are (or were) in the front
+        self.done = set()    # keys popped from the front
+        self.covered = set()
+        self.open = 0        # uncovered entries in the front
+        self.gap = False     # an uncovered entry has an unresolved ref
+        self._cutfct = cut
+        self.cut = None      # key of the entry at which we cut, if any
+        for t in tips:
+            self._push(t[1], self.worm.readMsg(t[1])['value']['content'])
+
+    def _push(self, k, m, covered=False):
+        self.seen.add(k)
+        if covered:
+            self.covered.add(k)
+        else:
+            self.open += 1
+        heapq.heappush(self.front, (_sortkey(k, m['height']), k, m))
+
+    def _uncover(self):
+        self.gap = True
+        for _, k, _ in self.front:
+            if k in self.covered:
+                self.covered.remove(k)
+                self.open += 1
+
+    def _cover(self, k):
+        if k in self.covered:
+            return
+        if k in self.seen:
+            if not k in self.done and not self.gap:
+                self.covered.add(k)
+                self.open -= 1
+            return
+        m = self.worm.readMsg(k)
+        if m:
+            self._push(k, m['value']['content'], covered=not self.gap)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        while len(self.front) > 0:
-            # find highest element
-            self.front = sorted(self.front,
-                                key=lambda e: float("%d.%d" % \
-                                     (e[1]['height'],
-                                      ssb.local.worm._hthash(e[0]))))
-            k, m = self.front.pop()
-            self.expanded.append(k)
+        while self.open > 0:
+            _, k, m = heapq.heappop(self.front) # highest element
+            self.done.add(k)
+            if k in self.covered:
+                for p in m.get('previous', []):
+                    self._cover(p[1])
+                continue
+            self.open -= 1
             if 'previous' in m: # don't return the genesis node
+                if self.cut is None and self._cutfct and \
+                                               self._cutfct(m.get('content')):
+                    self.cut = k
+                    for p in m['previous']:
+                        self._cover(p[1])
+                    return k
                 for p in m['previous']:
-                    if p[1] in self.expanded:
+                    if p[1] in self.seen:
                         continue
                     m2 = self.worm.readMsg(p[1])
                     if not m2:
+                        if not self.gap:
+                            self._uncover()
                         continue
-                    e = (p[1], m2['value']['content'])
-                    if not e in self.front:
-                        self.front.append(e)
+                    self._push(p[1], m2['value']['content'])
                 return k
         raise(StopIteration)
 
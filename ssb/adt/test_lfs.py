@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# ssb/adt/test_lfs.py
+
+import os
+import random
+
+import pytest
+
+import ssb.adt.lfs
+import ssb.adt.tangle
+import ssb.local.config
+import ssb.local.worm
+
+# ---------------------------------------------------------------------------
+
+def _user(name):
+    d = os.path.join(os.path.expanduser('~/.ssb'), 'user.' + name)
+    os.makedirs(d)
+    ssb.local.config.create_new_user_secret(os.path.join(d, 'secret'))
+    secr = ssb.local.config.SSB_SECRET(name)
+    return ssb.local.worm.SSB_WORM(name, secr, durability='none')
+
+@pytest.fixture()
+def users(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return _user
+
+def _sync(src, dst, feed, upto=None):
+    # replicate one feed (up to sequence number upto), as request_log_feed
+    # does
+    lst = []
+    end = src._getMaxSeq(feed)[1] if upto is None else upto
+    for i in range(dst._getMaxSeq(feed)[1]+1, end+1):
+        m = src.getMsgBySequence(feed, i)['value']
+        lst.append(ssb.local.worm.formatMsg(m['previous'], m['sequence'],
+                                            m['author'], m['timestamp'],
+                                            m['hash'], m['content'],
+                                            m['signature']))
+    if lst:
+        dst.appendMany(lst)
+
+def _names(fs):
+    return sorted([ dent['name'] for dent in fs.items() ])
+
+def _view(worm, base):
+    return sorted([ d['this'][1]
+                    for d in ssb.adt.lfs.lfs_dirs(worm).entries(base) ])
+
+def _cut(worm, base):
+    tips, _ = ssb.adt.tangle.tangle_tips(worm).tips(base)
+    return sorted(ssb.adt.lfs._lfs_replay(worm, tips)[0]) if tips else []
+
+def _full(worm, base):
+    # OR-Set over all msgs of the dir in the log
+    binds, unbinds = set(), set()
+    for rec in worm.records():
+        if rec.contentType != 'tangle':
+            continue
+        tan = rec.msg['value']['content']
+        if tan.get('base', [None, None])[1] != base or \
+                                          type(tan.get('content')) != dict:
+            continue
+        if tan['content'].get('type') == 'unbind':
+            unbinds.add(tan['content']['key'])
+        elif tan['content'].get('type') in ['bindF', 'bindD']:
+            binds.add(rec.key)
+    return sorted(binds - unbinds)
+
+def test_snapshot_partial(users):
+    # Dave has Bob's feed only: his snapshot would miss Alice's file
+    alice, bob, dave = users('Alice'), users('Bob'), users('Dave')
+    fa = ssb.adt.lfs.SSB_LFS(alice)
+    base = fa._root.getBaseRef()
+    fa.linkBlob('z', 1, '&' + 'A'*43 + '=.sha256')
+    _sync(alice, bob, alice.id)
+    fb = ssb.adt.lfs.SSB_LFS(bob, base)
+    fb.linkBlob('y', 1, '&' + 'B'*43 + '=.sha256')
+    _sync(bob, dave, bob.id)
+    fd = ssb.adt.lfs.SSB_LFS(dave, base)
+    with pytest.raises(OSError):
+        fd.snapshot()
+    _sync(bob, alice, bob.id)
+    fa.snapshot()
+    for w in [bob, dave]:
+        _sync(alice, w, alice.id)
+    _sync(alice, dave, bob.id)
+    for fs in [fa, fb, fd]:
+        assert _names(fs) == ['y', 'z']
+    # Dave has all of it now
+    fd.snapshot()
+    _sync(dave, alice, dave.id)
+    assert _names(fa) == ['y', 'z']
+
+def test_cut_gap(users):
+    # entries below a msg we lack are not covered by a snapshot
+    alice = users('Alice')
+    fa = ssb.adt.lfs.SSB_LFS(alice)
+    fa.linkBlob('z', 1, '&' + 'A'*43 + '=.sha256')
+    z = fa._cwt.tips[0]
+    fa.snapshot()
+    s = fa._cwt.tips[0]
+    # a concurrent branch, on top of a msg we don't have
+    x = { 'type': 'bindF', 'name': 'x', 'size': 1,
+          'blobkey': '&' + 'B'*43 + '=.sha256' }
+    alice.writeMsg({ 'type': 'tangle', 'base': fa._root.getBaseRef(),
+                     'previous': [[alice.id, '%' + 'A'*43 + '=.sha256']],
+                     'height': 2, 'content': x })
+    alice.flush()
+    it = ssb.adt.tangle.SSB_TANGLE_ITER(alice, fa._root._getTips()[0],
+                                        cut=ssb.adt.lfs._is_snapshot)
+    keys = list(it)
+    assert it.cut == s[1] and it.gap
+    assert z[1] in keys
+
+@pytest.mark.parametrize('seed', range(10))
+def test_partial_replication(users, seed):
+    # peers edit a dir and replicate single feeds at random, then all of
+    # them: the views, the replays and the full history agree
+    rnd = random.Random(seed)
+    peers = [ users('P%d' % i) for i in range(4) ]
+    fs0 = ssb.adt.lfs.SSB_LFS(peers[0])
+    base = fs0._root.getBaseRef()
+    for w in peers[1:]:
+        _sync(peers[0], w, peers[0].id)
+    fss = [fs0] + [ ssb.adt.lfs.SSB_LFS(w, base) for w in peers[1:] ]
+    for step in range(80):
+        i = rnd.randrange(len(peers))
+        r = rnd.random()
+        if r < 0.3:
+            fss[i].linkBlob('f%d' % step, 1, '&' + 'A'*43 + '=.sha256')
+        elif r < 0.45:
+            live = list(fss[i].items())
+            if live:
+                fss[i].unlinkBlob(rnd.choice(live)['this'][1])
+        elif r < 0.6:
+            try:
+                fss[i].snapshot()
+            except OSError:
+                pass
+        else:
+            j = rnd.randrange(len(peers))
+            if i != j:
+                _sync(peers[j], peers[i], rnd.choice(peers).id)
+    for i in range(2):
+        for src in peers:
+            for dst in peers:
+                for w in peers:
+                    _sync(src, dst, w.id)
+    full = _full(peers[0], base[1])
+    for w in peers:
+        assert _view(w, base[1]) == full
+        assert _cut(w, base[1]) == full
+        assert _full(w, base[1]) == full
+
+def test_dirs_reopen(users):
+    # the view is saved as a journal of changed dirs, then compacted
+    alice = users('Alice')
+    fs = ssb.adt.lfs.SSB_LFS(alice)
+    base = fs._root.getBaseRef()
+    dirs = ssb.adt.lfs.lfs_dirs(alice)
+    dirs.COMPACT_MIN = 2000
+    for i in range(20):
+        fs.linkBlob('f%d' % i, 1, '&' + 'A'*43 + '=.sha256')
+        alice.flush()
+    assert dirs._size > 0 and dirs._jsize > 0 # compacted, then journaled
+    fs.unlinkBlob(list(fs.items())[0]['this'][1])
+    alice.flush()
+    w = ssb.local.worm.SSB_WORM('Alice', ssb.local.config.SSB_SECRET('Alice'))
+    d = ssb.adt.lfs.lfs_dirs(w)
+    assert d.value == dirs.value and d.watermark == w._log.size
+    assert _view(w, base[1]) == _full(w, base[1])
+
+def _drives(worm):
+    return [ d['ref'] for d in ssb.adt.lfs.lfs_drives(worm).drives() ]
+
+@pytest.mark.parametrize('seed', range(5))
+def test_drives_order(users, seed):
+    # the registry agrees with a full scan while feeds arrive in pieces:
+    # members before their root, feeds interleaved, a drive we blocked
+    rnd = random.Random(seed)
+    ws = [ users('U%d' % i) for i in range(3) ]
+    fss = []
+    for s in range(30):
+        i = rnd.randrange(len(ws))
+        r = rnd.random()
+        if r < 0.2 or not fss:
+            fss.append(ssb.adt.lfs.SSB_LFS(ws[i]))
+        elif r < 0.7:
+            fs = rnd.choice(fss)
+            if fs._worm != ws[i]:
+                _sync(fs._worm, ws[i], fs._worm.id)
+                fs = ssb.adt.lfs.SSB_LFS(ws[i], fs._root.getBaseRef())
+            fs.linkBlob('f%d' % s, 1, '&' + 'A'*43 + '=.sha256')
+        elif r < 0.8:
+            fs = rnd.choice(fss)
+            fs.mkdir('d%d' % s)
+        else:
+            j = rnd.randrange(len(ws))
+            _sync(ws[j], ws[i], rnd.choice(ws).id)
+    new = users('New')
+    pieces = []
+    for w in ws:
+        n = w._getMaxSeq(w.id)[1]
+        pieces += [ (w, c) for c in sorted(rnd.sample(range(1, n+1),
+                                                      min(4, n))) + [n] ]
+    rnd.shuffle(pieces)
+    for w, upto in pieces:
+        _sync(w, new, w.id, upto)
+        assert _drives(new) == list(ssb.adt.lfs.LFS_ROOT_ITER(new))
+    ref = _drives(new)[-1]
+    ssb.adt.lfs.SSB_LFS(new, ref).close()
+    assert ref not in _drives(new)
+    assert _drives(new) == list(ssb.adt.lfs.LFS_ROOT_ITER(new))
+    w = ssb.local.worm.SSB_WORM('New', ssb.local.config.SSB_SECRET('New'))
+    assert _drives(w) == list(ssb.adt.lfs.LFS_ROOT_ITER(w))
+
+# eof
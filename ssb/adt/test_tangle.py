@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# ssb/adt/test_tangle.py
+
+import os
+import random
+
+import pytest
+
+import ssb.adt.tangle
+import ssb.local.config
+import ssb.local.worm
+
+# ---------------------------------------------------------------------------
+
+def _user(name):
+    d = os.path.join(os.path.expanduser('~/.ssb'), 'user.' + name)
+    os.makedirs(d)
+    ssb.local.config.create_new_user_secret(os.path.join(d, 'secret'))
+    secr = ssb.local.config.SSB_SECRET(name)
+    return ssb.local.worm.SSB_WORM(name, secr, durability='none')
+
+@pytest.fixture()
+def users(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return _user
+
+def _sync(src, dst, feed, upto=None):
+    # replicate one feed (up to sequence number upto)
+    lst = []
+    end = src._getMaxSeq(feed)[1] if upto is None else upto
+    for i in range(dst._getMaxSeq(feed)[1]+1, end+1):
+        m = src.getMsgBySequence(feed, i)['value']
+        lst.append(ssb.local.worm.formatMsg(m['previous'], m['sequence'],
+                                            m['author'], m['timestamp'],
+                                            m['hash'], m['content'],
+                                            m['signature']))
+    if lst:
+        dst.appendMany(lst)
+
+def _scan(worm, base):
+    # tips (in log order) and missing refs of a tangle, from the full log
+    # (records() yields the youngest entry first)
+    keys, refs = [], set()
+    for rec in worm.records():
+        if rec.contentType != 'tangle':
+            continue
+        tan = rec.msg['value']['content']
+        if rec.key == base:
+            keys.append(rec.key)
+        elif tan.get('base', [None, None])[1] == base:
+            keys.append(rec.key)
+            refs.add(base)
+            refs.update([ p[1] for p in tan.get('previous', []) ])
+    return ([ k for k in reversed(keys) if not k in refs ], refs - set(keys))
+
+def _check(worm, base):
+    tt = ssb.adt.tangle.tangle_tips(worm)
+    tips, missing = _scan(worm, base)
+    assert [ t[1] for t in reversed(tt.tips(base)[0]) ] == tips
+    assert set(tt.missing(base)) == missing
+
+def _tangle(users, n, steps, seed):
+    # n users append to one tangle, each sees the others' feeds at times
+    rnd = random.Random(seed)
+    ws = [ users('U%d' % i) for i in range(n) ]
+    t0 = ssb.adt.tangle.SSB_TANGLE(ws[0])
+    for w in ws[1:]:
+        _sync(ws[0], w, ws[0].id)
+    ts = [t0] + [ ssb.adt.tangle.SSB_TANGLE(w, t0.base) for w in ws[1:] ]
+    for s in range(steps):
+        i = rnd.randrange(n)
+        if rnd.random() < 0.5:
+            ts[i].refresh()
+            ts[i].append({ 'type': 'post', 'step': s })
+        else:
+            _sync(ws[rnd.randrange(n)], ws[i], rnd.choice(ws).id)
+    return (ws, t0.base[1])
+
+def test_members_before_genesis(users):
+    # Bob's msgs arrive before Alice's, whose feed holds the genesis
+    alice, bob, carol = users('Alice'), users('Bob'), users('Carol')
+    ta = ssb.adt.tangle.SSB_TANGLE(alice)
+    ta.append({ 'type': 'post' })
+    _sync(alice, bob, alice.id)
+    tb = ssb.adt.tangle.SSB_TANGLE(bob, ta.base)
+    tb.append({ 'type': 'post' })
+    tb.append({ 'type': 'post' })
+    _sync(bob, carol, bob.id)
+    _check(carol, ta.base[1])
+    assert ssb.adt.tangle.tangle_tips(carol).tips(ta.base[1])[0] == \
+                                   [ tuple(t) for t in tb.tips ]
+    _sync(alice, carol, alice.id, 1)
+    _check(carol, ta.base[1])
+    _sync(alice, carol, alice.id)
+    _check(carol, ta.base[1])
+    assert ssb.adt.tangle.tangle_tips(carol).missing(ta.base[1]) == []
+
+@pytest.mark.parametrize('seed', range(5))
+def test_interleaved(users, seed):
+    # a new peer gets the feeds in pieces, in random order
+    ws, base = _tangle(users, 3, 40, seed)
+    rnd = random.Random(seed)
+    new = users('New')
+    pieces = []
+    for w in ws:
+        n = w._getMaxSeq(w.id)[1]
+        cuts = sorted(rnd.sample(range(1, n+1), min(3, n)))
+        pieces += [ (w, c) for c in cuts + [n] ]
+    rnd.shuffle(pieces)
+    for w, upto in pieces:
+        _sync(w, new, w.id, upto)
+        _check(new, base)
+    for w in ws:
+        _sync(w, new, w.id)
+    _check(new, base)
+    for w in ws:
+        for f in ws:
+            _sync(f, w, f.id)
+        _check(w, base)
+        # same tips, in the order of each peer's log
+        assert sorted(ssb.adt.tangle.tangle_tips(w).tips(base)[0]) == \
+               sorted(ssb.adt.tangle.tangle_tips(new).tips(base)[0])
+
+# eof
@@ -4,6 +4,7 @@
 # 2018-08-31 (c) <christian.tschudin@unibas.ch>
 
 import cmd
+import codecs
 from   datetime import datetime
 from   fnmatch import fnmatch
 import json
@@ -11,6 +12,7 @@ import os
 import sys
 import traceback
 
+import ssb.adt.cdc
 import ssb.adt.lfs
 import ssb.local.config
 import ssb.local.worm
@@ -38,13 +40,17 @@ class SSB_DRV_REPL:
         remote = os.path.split(remote)[1] # FIXME: we should follow the path
         for dent in sorted(iter(self.fs.items()), key=lambda e: e['name']):
             if dent['name'] == remote and dent['type'] == 'bindF':
-                if self.fs._worm.blobAvailable(dent['blobkey']):
-                    data = self.fs._worm.readBlob(dent['blobkey'])
-                    self.print(data.decode('utf8'))
+                missing = self._missing(dent)
+                if not missing:
+                    dec = codecs.getincrementaldecoder('utf8')()
+                    for data in self._content(dent):
+                        self.stdout.write(dec.decode(data))
+                    self.stdout.write(dec.decode(b'', final=True) + '\n')
                     return
                 # self.print("** content not available (yet)")
                 if self.prefetchBlob:
-                   self.prefetchBlob(dent['blobkey'])
+                    for k in missing:
+                        self.prefetchBlob(k)
         self.print("** no such file, or content not available (yet)")
 
     def cd(self, path=None):
@@ -63,14 +69,16 @@ class SSB_DRV_REPL:
         remote = os.path.split(remote)[1] # FIXME: we should follow the path
         for dent in sorted(iter(self.fs.items()), key=lambda e: e['name']):
             if dent['name'] == remote and dent['type'] == 'bindF':
-                if self.fs._worm.blobAvailable(dent['blobkey']):
-                    data = self.fs._worm.readBlob(dent['blobkey'])
+                missing = self._missing(dent)
+                if not missing:
                     with open(local, "wb") as f:
-                        f.write(data)
+                        for data in self._content(dent):
+                            f.write(data)
                         return
                 # self.print("** content not available (yet)")
                 if self.prefetchBlob:
-                   self.prefetchBlob(dent['blobkey'])
+                    for k in missing:
+                        self.prefetchBlob(k)
         self.print("** no such file, or content not available (yet)")
 
     def ls(self, opt=None, glob=None):
@@ -89,6 +97,7 @@ class SSB_DRV_REPL:
             s = dent['name']
             if glob and not fnmatch(s, glob):
                 continue
+            missing = self._missing(dent) if dent['type'] == 'bindF' else []
             if dol:
                 if 'size' in dent:
                     if doh:
@@ -105,7 +114,7 @@ class SSB_DRV_REPL:
 
                 if dent['type'] == 'bindF':
                     # test if referenced blob is locally available
-                    if self.fs._worm.blobAvailable(dent['blobkey']):
+                    if not missing:
                         q = '- '
                     else:
                         q = '-?'
@@ -121,9 +130,9 @@ class SSB_DRV_REPL:
                     q = dent['this'][1] + ' ' + q
 
             # trigger proactive fetch of blobs
-            if self.prefetchBlob and dent['type'] == 'bindF' and \
-                            not self.fs._worm.blobAvailable(dent['blobkey']):
-                self.prefetchBlob(dent['blobkey'])
+            if self.prefetchBlob:
+                for k in missing:
+                    self.prefetchBlob(k)
 
             lines.append((q,r,s))
         w = 0
@@ -140,15 +149,35 @@ class SSB_DRV_REPL:
         except ValueError:
             self.print("** no such path")
 
-    def put(self, local, remote=None):
+    def put(self, opt, local=None, remote=None):
+        if opt[0] != '-':
+            opt, local, remote = '-', opt, local
+        if not local:
+            raise TypeError
         with open(local, 'rb') as f:
-            data = f.read()
-        key = self.fs._worm.writeBlob(data)
+            if 'c' in opt: # content-defined chunks
+                key, size = ssb.adt.cdc.write_chunked(self.fs._worm, f)
+            else:
+                key, size = self.fs._worm.writeBlobFrom(f)
         if not remote:
             remote = os.path.split(local)[1]
         else:
             remote = os.path.split(remote)[1] # FIXME: we should follow the path
-        self.fs.linkBlob(remote, len(data), key)
+        self.fs.linkBlob(remote, size, key, chunked='c' in opt)
+
+    def _missing(self, dent):
+        # keys of the blobs still needed for this file's content
+        if dent.get('chunked'):
+            return ssb.adt.cdc.missing_chunked(self.fs._worm, dent['blobkey'])
+        if self.fs._worm.blobAvailable(dent['blobkey']):
+            return []
+        return [dent['blobkey']]
+
+    def _content(self, dent):
+        # iterate over the file's content
+        if dent.get('chunked'):
+            return ssb.adt.cdc.read_chunked(self.fs._worm, dent['blobkey'])
+        return self.fs._worm.readBlobChunks(dent['blobkey'])
 
     def pwd(self):
         self.print(self.fs.getcwd())
@@ -188,6 +217,15 @@ class SSB_DRV_REPL:
             cnt += 1
         if cnt == 0:
             self.print("** no such directory")
+
+    def snapshot(self):
+        try:
+            ref = self.fs.snapshot()
+        except OSError as e:
+            self.print("**", e)
+            return
+        self.print("snapshot of '%s': %s" % (self.fs.getcwd(), ref[1]))
+
     def stat(self, opt=None, glob=None):
         if opt is not None and opt[0] != '-':
             glob = opt
@@ -289,7 +327,7 @@ class DRIVE_CMD(cmd.Cmd):
         self.doit(self.repl.mkdir, arg)
 
     def do_put(self, arg):
-        'put  local-path [remote-path]'
+        'put  [-c] local-path [remote-path] ; -c: content-defined chunks'
         self.doit(self.repl.put, arg)
 
     def do_pwd(self, arg):
@@ -308,6 +346,10 @@ class DRIVE_CMD(cmd.Cmd):
         'rmdir  path [key]     ; remove directory' 
         self.doit(self.repl.rmdir, arg)
 
+    def do_snapshot(self, arg):
+        'snapshot              ; record the state of the current directory'
+        self.doit(self.repl.snapshot, arg)
+
     def do_stat(self, arg):
         'stat  [-1] [glob]     ; display file status (for names matching glob)'
         self.doit(self.repl.stat, arg)
@@ -366,14 +408,14 @@ if __name__ == '__main__':
     else:
         if args.list:
             print("Available SSB drives:")
-            for ref in ssb.adt.lfs.find_lfs_root_iter(wa):
-                m = wa.readMsg(ref[1])
-                t = datetime.utcfromtimestamp(m['value']['timestamp']/1000)
-                u = ssb.adt.lfs.uuid_from_key(wa, ref[1])
-                print("  uuid=%s  (%s)" % (u, str(t)[:19]))
+            for d in ssb.adt.lfs.lfs_drives(wa).drives():
+                t = datetime.utcfromtimestamp(d['created']/1000)
+                print("  uuid=%s  (%s)" % (d['uuid'], str(t)[:19]))
+            wa.flush()
             sys.exit(0)
         if args.new:
             fs = ssb.adt.lfs.SSB_LFS(wa)
+            wa.flush()
             print("new drive created, uuid=" + fs.uuid())
             sys.exit(0)
 
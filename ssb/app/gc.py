@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# ssb/app/gc.py - garbage collection of blobs no drive refers to anymore
+
+import ssb.adt.cdc
+import ssb.adt.lfs
+import ssb.local.config
+import ssb.local.worm
+from ssb.local.util import id2bytes
+
+# ---------------------------------------------------------------------------
+
+COMPACT_DEAD = 0.5 # compact packs beyond this fraction of the live bytes
+
+def reachable_blobs(worm, own=False):
+    # hex hashes of the blobs referenced by live files of all drives which
+    # we did not block (directory state from SSB_LFS_DIRS),
+    # or only of the drives we created if own is True
+    dirs = ssb.adt.lfs.lfs_dirs(worm)
+    keep = set()
+    seen = set()
+    todo = [ d['ref'][1] for d in ssb.adt.lfs.lfs_drives(worm).drives()
+                                       if not own or d['ref'][0] == worm.id ]
+    while len(todo) > 0:
+        base = todo.pop()
+        if base in seen: # protect against cycles in the fs
+            continue
+        seen.add(base)
+        for dent in dirs.entries(base):
+            if dent['type'] == 'bindF':
+                keep.add(id2bytes(dent['blobkey']).hex())
+                if dent.get('chunked') and \
+                                      worm.blobAvailable(dent['blobkey']):
+                    m = ssb.adt.cdc.read_manifest(worm, dent['blobkey'])
+                    keep.update([ id2bytes(k).hex() for k,_ in m['chunks'] ])
+            elif dent['type'] == 'bindD':
+                todo.append(dent['dirref'][1])
+    return keep
+
+def pin_own_drives(worm):
+    # fetched blobs which our own drives refer to stay in the blob cache
+    worm.blobPins = lambda: reachable_blobs(worm, own=True)
+
+def collect(worm, quota=0, dryrun=False):
+    # remove unreferenced blobs, largest first, until the blob store uses
+    # at most quota bytes (0: remove all of them).
+    # Returns (bytes used, bytes reclaimable, bytes freed)
+    store = worm._blobs
+    keep = reachable_blobs(worm)
+    used = 0
+    garbage = []
+    for hx in store.keys():
+        sz = store.size(hx)
+        used += sz
+        if not hx in keep:
+            garbage.append( (sz, hx) )
+    reclaimable = sum([ g[0] for g in garbage ])
+    freed = 0
+    if not dryrun:
+        for sz, hx in sorted(garbage, reverse=True):
+            if used - freed <= quota:
+                break
+            store.remove(hx)
+            worm._blobCache.forget(hx)
+            freed += sz
+        if store.dead() > (used - freed) * COMPACT_DEAD:
+            store.compact()
+    return (used, reclaimable, freed)
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='SSB-Drive blob collector')
+    parser.add_argument('-user', metavar='USERNAME', type=str, dest='username',
+                        help='username (default is ~/.ssb user)')
+    parser.add_argument('-quota', metavar='BYTES', type=int, default=0,
+                        help='keep unreferenced blobs up to this total size')
+    parser.add_argument('-n', action='store_true', dest='dryrun',
+                        help='only report, do not remove anything')
+    args = parser.parse_args()
+
+    p = ssb.local.worm.is_locked(args.username)
+    if p:
+        raise Exception("log file is locked by process %d (%s)" % \
+                        (p.pid, p.name()))
+
+    secr = ssb.local.config.SSB_SECRET(args.username)
+    wa = ssb.local.worm.SSB_WORM(args.username, secr)
+    used, reclaimable, freed = collect(wa, args.quota, args.dryrun)
+    wa.flush()
+    print("blobs use %d bytes, %d bytes are unreferenced" % (used, reclaimable))
+    if not args.dryrun:
+        print("** %d bytes freed" % freed)
+
+# eof
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# ssb/app/test_gc.py
+
+import io
+import os
+
+import pytest
+
+import ssb.adt.cdc
+import ssb.adt.lfs
+import ssb.app.gc
+import ssb.local.config
+import ssb.local.worm
+from ssb.local.util import id2bytes
+
+# ---------------------------------------------------------------------------
+
+def _hx(key):
+    return id2bytes(key).hex()
+
+@pytest.fixture(params=['dir', 'pack'])
+def drive(tmp_path, monkeypatch, request):
+    # a drive with a file, a chunked file, a file in a subdirectory and a
+    # removed file, plus a blob no file refers to
+    monkeypatch.setenv('HOME', str(tmp_path))
+    d = os.path.join(str(tmp_path), '.ssb', 'user.Alice')
+    os.makedirs(d)
+    if request.param == 'pack':
+        os.makedirs(os.path.join(d, 'blobs', 'packs'))
+    ssb.local.config.create_new_user_secret(os.path.join(d, 'secret'))
+    w = ssb.local.worm.SSB_WORM('Alice', ssb.local.config.SSB_SECRET('Alice'))
+    fs = ssb.adt.lfs.SSB_LFS(w)
+    live, gone = set(), {}
+    k = w.writeBlob(os.urandom(3000))
+    fs.linkBlob('a', 3000, k)
+    live.add(_hx(k))
+    k, sz = ssb.adt.cdc.write_chunked(w, io.BytesIO(os.urandom(200000)))
+    fs.linkBlob('b', sz, k, chunked=True)
+    live.add(_hx(k))
+    live.update([ _hx(c) for c,_ in ssb.adt.cdc.read_manifest(w, k)['chunks'] ])
+    fs.mkdir('sub')
+    fs.cd('sub')
+    k = w.writeBlob(os.urandom(1000))
+    fs.linkBlob('c', 1000, k)
+    live.add(_hx(k))
+    k = w.writeBlob(os.urandom(5000))
+    fs.linkBlob('d', 5000, k)
+    fs.unlinkBlob([ e for e in fs.items() if e['name'] == 'd' ][0]['this'][1])
+    gone[_hx(k)] = 5000
+    k = w.writeBlob(os.urandom(2000))
+    gone[_hx(k)] = 2000
+    w.flush()
+    return (w, live, gone)
+
+def test_reachable(drive):
+    w, live, gone = drive
+    assert ssb.app.gc.reachable_blobs(w) == live
+    assert ssb.app.gc.reachable_blobs(w, own=True) == live
+
+def test_blocked(drive):
+    # the blobs of a blocked drive are garbage
+    w, live, gone = drive
+    ssb.adt.lfs.SSB_LFS(w, ssb.adt.lfs.find_lfs_mostRecent(w)).close()
+    assert ssb.app.gc.reachable_blobs(w) == set()
+
+def test_dryrun(drive):
+    w, live, gone = drive
+    used, reclaimable, freed = ssb.app.gc.collect(w, dryrun=True)
+    assert reclaimable == sum(gone.values()) and freed == 0
+    assert used == sum([ w._blobs.size(hx) for hx in live ]) + reclaimable
+    for hx in list(live) + list(gone):
+        assert w._blobs.has(hx)
+
+def test_collect(drive):
+    w, live, gone = drive
+    used, reclaimable, freed = ssb.app.gc.collect(w)
+    assert freed == reclaimable == sum(gone.values())
+    assert sorted(w._blobs.keys()) == sorted(live)
+    fs = ssb.adt.lfs.SSB_LFS(w, ssb.adt.lfs.find_lfs_mostRecent(w))
+    for dent in fs.items():
+        if dent.get('chunked'):
+            assert len(b''.join(ssb.adt.cdc.read_chunked(w,
+                                                 dent['blobkey']))) == 200000
+        elif dent['type'] == 'bindF':
+            assert len(w.readBlob(dent['blobkey'])) == dent['size']
+    assert ssb.app.gc.collect(w) == (used - freed, 0, 0)
+
+def test_quota(drive):
+    # the largest unreferenced blobs go first
+    w, live, gone = drive
+    used = ssb.app.gc.collect(w, dryrun=True)[0]
+    assert ssb.app.gc.collect(w, quota=used-1)[2] == 5000
+    assert [ hx for hx in gone if w._blobs.has(hx) ] == \
+           [ hx for hx in gone if gone[hx] == 2000 ]
+    assert ssb.app.gc.collect(w, quota=used)[2] == 0
+
+def test_compact_dead(drive, monkeypatch):
+    # the packs are only rewritten once enough of them is dead
+    w, live, gone = drive
+    compacted = []
+    monkeypatch.setattr(w._blobs, 'compact', lambda: compacted.append(1))
+    monkeypatch.setattr(ssb.app.gc, 'COMPACT_DEAD', 1.0)
+    ssb.app.gc.collect(w)
+    assert compacted == []
+    monkeypatch.setattr(ssb.app.gc, 'COMPACT_DEAD', 0.01)
+    ssb.app.gc.collect(w)
+    assert compacted == ([1] if w._blobs.dead() > 0 else [])
+
+# eof
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+
+# ssb/local/blobs.py
+# blob stores: one file per blob (as ssb-js), or append-only pack files
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# ---------------------------------------------------------------------------
+
+"""
+
+A user's blobs/ directory holds one of two layouts:
+
+* blobs/sha256/xx/yyyy..  one file per blob, named by its hex hash
+
+* blobs/packs/            used if this directory exists:
+    NNNNNNNN.pack         blobs appended back to back
+    index                 52 byte records, appended:
+                            hash(32) + UInt32BE(pack) +
+                            UInt64BE(offset) + UInt64BE(length)
+                          pack 0xffffffff: the blob was removed
+
+Space of removed blobs in pack files is reclaimed by compact().
+
+* blobs/cache.json        optional, see SSB_BLOBS_CACHE
+
+New blobs are written to blobs/tmp first and handed to the store with
+store(tmpName, hexhash), which moves (or copies) them into place.
+
+"""
+
+PACK_MAX = 256*1024*1024 # start a new pack file beyond this size
+_NDXREC = 52
+_REMOVED = 0xffffffff # pack number of an index record which removes a blob
+
+class SSB_BLOBS_DIR:
+
+    def __init__(self, dname, readonly=False):
+        self._dname = os.path.join(dname, 'sha256')
+        self.tmpDname = os.path.join(dname, 'tmp')
+        self._present = None # set of hex hashes, built on first use
+        if not os.path.isdir(self._dname):
+            if readonly:
+                raise Exception("no blob directory")
+            os.makedirs(self._dname)
+
+    def _fname(self, hx):
+        return os.path.join(self._dname, hx[:2], hx[2:])
+
+    def has(self, hx):
+        # no stat per blob: this process is the only writer (log lock)
+        if self._present is None:
+            self._present = set(self.keys())
+        return hx in self._present
+
+    def size(self, hx):
+        return os.path.getsize(self._fname(hx))
+
+    def chunks(self, hx, chunkSize):
+        with open(self._fname(hx), "rb") as f:
+            while True:
+                data = f.read(chunkSize)
+                if not data:
+                    return
+                yield data
+
+    def store(self, tmpName, hx):
+        fn = self._fname(hx)
+        if os.path.isfile(fn):
+            os.remove(tmpName)
+        else:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            os.replace(tmpName, fn)
+        if self._present is not None:
+            self._present.add(hx)
+
+    def remove(self, hx):
+        os.remove(self._fname(hx))
+        if self._present is not None:
+            self._present.discard(hx)
+
+    def dead(self):
+        return 0
+
+    def compact(self):
+        return 0
+
+    def keys(self):
+        for d in os.listdir(self._dname):
+            p = os.path.join(self._dname, d)
+            if len(d) == 2 and os.path.isdir(p):
+                for f in os.listdir(p):
+                    yield d + f
+
+    def close(self):
+        pass
+
+
+class SSB_BLOBS_PACK:
+
+    def __init__(self, dname, readonly=False, fsync=False, packDname=None):
+        self._dname = packDname if packDname else os.path.join(dname, 'packs')
+        self.tmpDname = os.path.join(dname, 'tmp')
+        self._readonly = readonly
+        self._fsync = fsync
+        self._ndx = {} # hash -> (pack, offset, length)
+        self._pack = None
+        self._packNo = 0
+        if not os.path.isdir(self._dname):
+            if readonly:
+                raise Exception("no blob directory")
+            os.makedirs(self._dname)
+        self._ndxFname = os.path.join(self._dname, 'index')
+        if os.path.isfile(self._ndxFname):
+            with open(self._ndxFname, "rb") as f:
+                buf = f.read()
+            cnt = len(buf) // _NDXREC
+            for i in range(cnt):
+                r = buf[i*_NDXREC:(i+1)*_NDXREC]
+                p = int.from_bytes(r[32:36], 'big')
+                self._ndx[r[:32]] = (p,
+                                     int.from_bytes(r[36:44], 'big'),
+                                     int.from_bytes(r[44:52], 'big'))
+                if p == _REMOVED:
+                    del self._ndx[r[:32]]
+                    continue
+                self._packNo = max(self._packNo, p)
+            if len(buf) != cnt * _NDXREC and not readonly:
+                # partially written record (crash): drop it
+                with open(self._ndxFname, "r+b") as f:
+                    f.truncate(cnt * _NDXREC)
+
+    def _packFname(self, p):
+        return os.path.join(self._dname, '%08d.pack' % p)
+
+    def has(self, hx):
+        return bytes.fromhex(hx) in self._ndx
+
+    def size(self, hx):
+        return self._ndx[bytes.fromhex(hx)][2]
+
+    def chunks(self, hx, chunkSize):
+        p, offs, cnt = self._ndx[bytes.fromhex(hx)]
+        with open(self._packFname(p), "rb") as f:
+            f.seek(offs)
+            while cnt > 0:
+                data = f.read(min(chunkSize, cnt))
+                if not data:
+                    raise OSError("truncated pack file")
+                cnt -= len(data)
+                yield data
+
+    def _sync(self, f):
+        f.flush()
+        if self._fsync:
+            os.fsync(f.fileno())
+
+    def _append(self, f, cnt):
+        # copy cnt bytes from file f to the current pack, returns the
+        # (pack, offset) where they were written
+        if not self._pack:
+            self._pack = open(self._packFname(self._packNo), "ab")
+        if self._pack.tell() > 0 and self._pack.tell() + cnt > PACK_MAX:
+            self._pack.close()
+            self._packNo += 1
+            self._pack = open(self._packFname(self._packNo), "ab")
+        offs = self._pack.tell()
+        todo = cnt
+        while todo > 0:
+            data = f.read(min(todo, 65536))
+            if not data:
+                raise OSError("short copy to pack file")
+            self._pack.write(data)
+            todo -= len(data)
+        self._sync(self._pack)
+        return (self._packNo, offs)
+
+    def _addRecord(self, h, p, offs, cnt):
+        with open(self._ndxFname, "ab") as f:
+            f.write(h + p.to_bytes(4, 'big') +
+                    offs.to_bytes(8, 'big') + cnt.to_bytes(8, 'big'))
+            self._sync(f)
+
+    def store(self, tmpName, hx):
+        h = bytes.fromhex(hx)
+        if h in self._ndx:
+            os.remove(tmpName)
+            return
+        cnt = os.path.getsize(tmpName)
+        with open(tmpName, "rb") as f:
+            p, offs = self._append(f, cnt)
+        # the blob is only visible once its index record is written
+        self._addRecord(h, p, offs, cnt)
+        self._ndx[h] = (p, offs, cnt)
+        os.remove(tmpName)
+
+    def remove(self, hx):
+        h = bytes.fromhex(hx)
+        if h in self._ndx:
+            self._addRecord(h, _REMOVED, 0, 0)
+            del self._ndx[h]
+
+    def _packs(self):
+        return [ f for f in os.listdir(self._dname) if f.endswith('.pack') ]
+
+    def dead(self):
+        # bytes in the pack files taken by removed blobs
+        total = sum([ os.path.getsize(os.path.join(self._dname, f))
+                                                   for f in self._packs() ])
+        return total - sum([ e[2] for e in self._ndx.values() ])
+
+    def compact(self):
+        # copy the remaining blobs to new pack files, switch to a new index
+        # (atomically, by rename) and delete the old packs. Returns the
+        # number of bytes freed.
+        packs = self._packs()
+        freed = self.dead()
+        if freed == 0:
+            return 0
+        self.close()
+        old = self._ndx
+        first = self._packNo + 1
+        self._packNo = first
+        self._ndx = {}
+        ndxFname = self._ndxFname
+        self._ndxFname += '.new'
+        if os.path.isfile(self._ndxFname):
+            os.remove(self._ndxFname)
+        for h, (p, offs, cnt) in old.items():
+            with open(self._packFname(p), "rb") as f:
+                f.seek(offs)
+                q, offs = self._append(f, cnt)
+            self._addRecord(h, q, offs, cnt)
+            self._ndx[h] = (q, offs, cnt)
+        self.close()
+        os.replace(self._ndxFname, ndxFname)
+        self._ndxFname = ndxFname
+        for f in packs:
+            if int(f.split('.')[0]) < first:
+                os.remove(os.path.join(self._dname, f))
+        return freed
+
+    def keys(self):
+        for h in list(self._ndx):
+            yield h.hex()
+
+    def close(self):
+        if self._pack:
+            self._pack.close()
+            self._pack = None
+
+
+class SSB_BLOBS_CACHE:
+
+    # blobs/cache.json, if present, turns on the cache mode: blobs fetched
+    # from peers ("foreign") are tracked with their last access time, and
+    # the least recently used ones are evicted once they take more than
+    # 'budget' bytes. Blobs we wrote ourselves are never tracked, and
+    # callers can pin foreign ones (e.g. those our own drives refer to).
+    #   { 'budget': bytes, 'foreign': { hexhash: [size, last access] } }
+    #
+    # pinned blobs do not count against the budget, and the packs are only
+    # rewritten once the evicted blobs left enough dead bytes in them
+
+    COMPACT_DEAD = 0.5 # compact beyond this fraction of the budget
+
+    def __init__(self, dname, readonly=False):
+        self._fname = os.path.join(dname, 'cache.json')
+        self._readonly = readonly
+        self._dirty = False
+        self.budget = None
+        self.foreign = {}
+        self.used = 0
+        self._pinned = set() # foreign blobs found pinned by the last evict
+        self.pinned = 0
+        if os.path.isfile(self._fname):
+            with open(self._fname, "r") as f:
+                d = json.load(f)
+            self.budget = d['budget']
+            self.foreign = d['foreign']
+            self.used = sum([ e[0] for e in self.foreign.values() ])
+
+    @property
+    def enabled(self):
+        return self.budget is not None
+
+    def add(self, hx, size, foreign):
+        if not self.enabled:
+            return
+        if foreign:
+            if not hx in self.foreign:
+                self.foreign[hx] = [size, time.time()]
+                self.used += size
+                self._dirty = True
+        else: # (also) written by us: keep it
+            self.forget(hx)
+
+    def forget(self, hx):
+        e = self.foreign.pop(hx, None)
+        if e:
+            self.used -= e[0]
+            self._dirty = True
+            if hx in self._pinned:
+                self._pinned.discard(hx)
+                self.pinned -= e[0]
+
+    def touch(self, hx):
+        e = self.foreign.get(hx)
+        if e:
+            e[1] = time.time()
+            self._dirty = True
+
+    def over(self):
+        return self.enabled and self.used - self.pinned > self.budget
+
+    def evict(self, store, pinned=set()):
+        # remove least recently used foreign blobs which are not pinned,
+        # down to 90% of the budget (so that this does not run for every
+        # fetched blob). Returns the number of bytes freed.
+        self._pinned = set([ hx for hx in self.foreign if hx in pinned ])
+        self.pinned = sum([ self.foreign[hx][0] for hx in self._pinned ])
+        freed = 0
+        for hx, e in sorted(self.foreign.items(), key=lambda e: e[1][1]):
+            if self.used - self.pinned <= self.budget * 0.9:
+                break
+            if hx in self._pinned:
+                continue
+            if store.has(hx):
+                store.remove(hx)
+                freed += e[0]
+            self.forget(hx)
+        if store.dead() > self.budget * self.COMPACT_DEAD:
+            store.compact()
+        return freed
+
+    def configure(self, budget):
+        # budget None: turn the cache mode off
+        self.budget = budget
+        if budget is None:
+            self.foreign = {}
+            self.used = 0
+            if os.path.isfile(self._fname):
+                os.remove(self._fname)
+            self._dirty = False
+        else:
+            self._dirty = True
+        self.flush()
+
+    def flush(self):
+        if not self._dirty or self._readonly or not self.enabled:
+            return
+        with open(self._fname, "w") as f:
+            json.dump({ 'budget': self.budget, 'foreign': self.foreign }, f)
+        self._dirty = False
+
+
+def open_blobs(dname, readonly=False, fsync=False):
+    # the store found in this blobs directory (default: one file per blob)
+    if os.path.isdir(os.path.join(dname, 'packs')):
+        return SSB_BLOBS_PACK(dname, readonly, fsync)
+    return SSB_BLOBS_DIR(dname, readonly)
+
+def _copy(src, dst, hx):
+    os.makedirs(dst.tmpDname, exist_ok=True)
+    fd, tmpName = tempfile.mkstemp(dir=dst.tmpDname)
+    with os.fdopen(fd, "wb") as f:
+        for data in src.chunks(hx, 65536):
+            f.write(data)
+    dst.store(tmpName, hx)
+
+def migrate(dname, to, progress=None):
+    # convert a blobs directory to the 'pack' or 'files' layout. Blobs are
+    # copied first and the old layout is removed at the end: an
+    # interrupted migration can be restarted.
+    packs = os.path.join(dname, 'packs')
+    if to == 'pack':
+        src = SSB_BLOBS_DIR(dname)
+        if os.path.isdir(packs):
+            dst = SSB_BLOBS_PACK(dname)
+        else:
+            dst = SSB_BLOBS_PACK(dname, packDname=packs + '.new')
+    elif to == 'files':
+        if not os.path.isdir(packs):
+            return 0
+        src = SSB_BLOBS_PACK(dname, readonly=True)
+        dst = SSB_BLOBS_DIR(dname)
+    else:
+        raise ValueError("unknown blob layout %s" % to)
+    cnt = 0
+    for hx in src.keys():
+        _copy(src, dst, hx)
+        cnt += 1
+        if progress:
+            progress(cnt)
+    dst.close()
+    if to == 'pack':
+        if not os.path.isdir(packs):
+            os.rename(packs + '.new', packs)
+        shutil.rmtree(os.path.join(dname, 'sha256'))
+        os.makedirs(os.path.join(dname, 'sha256'))
+    else:
+        shutil.rmtree(packs)
+    return cnt
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    import argparse
+    from ssb.local.util import username2dir, is_locked
+
+    parser = argparse.ArgumentParser(description='SSB blob store converter')
+    parser.add_argument('-user', metavar='USERNAME', type=str, dest='username',
+                        help='username (default is ~/.ssb user)')
+    parser.add_argument('-to', choices=['pack', 'files'],
+                        help='new layout: pack files, or one file per blob')
+    parser.add_argument('-cache', metavar='BYTES', type=int,
+                        help='evict fetched blobs beyond this size (-1: off)')
+    args = parser.parse_args()
+    if args.to is None and args.cache is None:
+        parser.error("one of -to or -cache is required")
+
+    p = is_locked(args.username)
+    if p:
+        print("** log file is locked by process %d (%s)" % (p.pid, p.name()))
+        sys.exit(1)
+
+    dname = os.path.join(username2dir(args.username), 'blobs')
+    if not os.path.isdir(dname):
+        print("** no blob directory")
+        sys.exit(1)
+    if args.to:
+        cnt = migrate(dname, args.to,
+                      lambda n: print("\r%d blobs" % n, end='', flush=True))
+        print("\r** %d blobs converted to layout '%s'" % (cnt, args.to))
+    if args.cache is not None:
+        SSB_BLOBS_CACHE(dname).configure(args.cache if args.cache >= 0
+                                         else None)
+        print("** blob cache", "off" if args.cache < 0 else
+                               "budget set to %d bytes" % args.cache)
+
+# eof
@@ -3,6 +3,7 @@
 # ssb_local/config.py
 
 import base64
+import functools
 import json
 import nacl.signing
 import os
@@ -17,10 +18,15 @@ def username2dir(n):
 def id2bytes(id):
     return base64.b64decode(id.split('.')[0][1:])
 
+@functools.lru_cache(maxsize=4096)
+def _verify_key(id):
+    # VerifyKey objects are immutable, keep them per author
+    return nacl.signing.VerifyKey(base64.b64decode(id[1:-8]))
+
 def verify_signature(id, data, sig):
     if type(data) == str:
         data = data.encode('utf8')
-    vk = nacl.signing.VerifyKey(base64.b64decode(id[1:-8]))
+    vk = _verify_key(id)
     try:
         vk.verify(data, sig)
         return True
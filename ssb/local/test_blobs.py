@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# ssb/local/test_blobs.py
+
+import hashlib
+import os
+
+import pytest
+
+from ssb.local.blobs import SSB_BLOBS_PACK, _NDXREC
+
+# ---------------------------------------------------------------------------
+
+def _store(st, data):
+    os.makedirs(st.tmpDname, exist_ok=True)
+    fname = os.path.join(st.tmpDname, 'blob')
+    with open(fname, 'wb') as f:
+        f.write(data)
+    hx = hashlib.sha256(data).hexdigest()
+    st.store(fname, hx)
+    return hx
+
+def _read(st, hx):
+    return b''.join(st.chunks(hx, 1000))
+
+@pytest.fixture()
+def blobs(tmp_path, monkeypatch):
+    # a pack store with a few blobs, one of them removed again
+    monkeypatch.setenv('HOME', str(tmp_path))
+    d = os.path.join(str(tmp_path), 'blobs')
+    st = SSB_BLOBS_PACK(d)
+    data = [ os.urandom(3000 + i) for i in range(5) ]
+    hxs = [ _store(st, x) for x in data ]
+    st.remove(hxs[1])
+    st.close()
+    return (d, dict(zip(hxs, data)), hxs[1])
+
+def test_reopen(blobs):
+    d, data, removed = blobs
+    st = SSB_BLOBS_PACK(d)
+    for hx, x in data.items():
+        if hx == removed:
+            assert not st.has(hx)
+        else:
+            assert _read(st, hx) == x
+
+def test_torn_index_record(blobs):
+    # a crash while appending an index record leaves a partial one
+    d, data, removed = blobs
+    fname = os.path.join(d, 'packs', 'index')
+    sz = os.path.getsize(fname)
+    with open(fname, 'ab') as f:
+        f.write(os.urandom(_NDXREC // 2))
+    st = SSB_BLOBS_PACK(d)
+    assert os.path.getsize(fname) == sz
+    for hx, x in data.items():
+        if hx != removed:
+            assert _read(st, hx) == x
+    # records appended after the truncation are found again
+    hx = _store(st, b'after the crash')
+    st.close()
+    st = SSB_BLOBS_PACK(d)
+    assert _read(st, hx) == b'after the crash'
+    assert not st.has(removed)
+
+def test_torn_last_record(blobs):
+    # the last blob's record is cut: that blob is lost, the others are not
+    d, data, removed = blobs
+    fname = os.path.join(d, 'packs', 'index')
+    with open(fname, 'r+b') as f:
+        f.truncate(os.path.getsize(fname) - 10)
+    st = SSB_BLOBS_PACK(d)
+    assert os.path.getsize(fname) % _NDXREC == 0
+    assert st.has(removed) # its tombstone was the last record
+    for hx, x in data.items():
+        assert _read(st, hx) == x
+
+def test_compact(blobs):
+    d, data, removed = blobs
+    st = SSB_BLOBS_PACK(d)
+    assert st.dead() == len(data[removed])
+    assert st.compact() == len(data[removed])
+    assert st.dead() == 0
+    st = SSB_BLOBS_PACK(d)
+    for hx, x in data.items():
+        assert st.has(hx) == (hx != removed)
+        if hx != removed:
+            assert _read(st, hx) == x
+
+# eof
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# ssb/local/test_worm.py
+
+import asyncio
+import os
+
+import pytest
+
+import ssb.local.config
+import ssb.local.worm
+from ssb.local.worm import _hthash
+
+# ---------------------------------------------------------------------------
+
+@pytest.fixture()
+def worm(tmp_path, monkeypatch):
+    # a log with a few msgs, in a fresh ~/.ssb
+    monkeypatch.setenv('HOME', str(tmp_path))
+    d = os.path.join(str(tmp_path), '.ssb', 'user.Alice')
+    os.makedirs(d)
+    ssb.local.config.create_new_user_secret(os.path.join(d, 'secret'))
+    secr = ssb.local.config.SSB_SECRET('Alice')
+    w = ssb.local.worm.SSB_WORM('Alice', secr)
+    for i in range(20):
+        w.writeMsg({ 'type': 'post', 'text': 'msg %d' % i })
+    w.flush()
+    return w
+
+def _msgStrs(name, n):
+    # n signed msgs of a new user, formatted as received from a peer
+    d = os.path.join(os.path.expanduser('~/.ssb'), 'user.' + name)
+    os.makedirs(d)
+    ssb.local.config.create_new_user_secret(os.path.join(d, 'secret'))
+    w = ssb.local.worm.SSB_WORM(name, ssb.local.config.SSB_SECRET(name))
+    for i in range(n):
+        w.writeMsg({ 'type': 'post', 'text': '%s %d' % (name, i) })
+    lst = []
+    for i in range(n):
+        m = w.getMsgBySequence(w.id, i+1)['value']
+        lst.append(ssb.local.worm.formatMsg(m['previous'], m['sequence'],
+                                            m['author'], m['timestamp'],
+                                            m['hash'], m['content'],
+                                            m['signature']))
+    return lst
+
+def _bad(msgStr):
+    i = msgStr.index('"signature": "') + 14
+    return msgStr[:i] + ('B' if msgStr[i] == 'A' else 'A') + msgStr[i+1:]
+
+def _legacy_keys_ht(worm, vers):
+    # write keys.ht of the given worm in the v2 or v3 format
+    width = 4 if vers == 2 else 8
+    slots = 64
+    tbl = bytearray(width*slots)
+    keys = list(worm)
+    for k in keys:
+        pos = _hthash(k) % slots
+        while int.from_bytes(tbl[pos*width:(pos+1)*width], 'big') != 0:
+            pos = (pos+1) % slots
+        offs = worm.offsetOf(k)
+        tbl[pos*width:(pos+1)*width] = (offs+1).to_bytes(width, 'big')
+    wm = worm._keysHT.watermark
+    with open(worm._keysHT._fname, 'wb') as f:
+        f.write(vers.to_bytes(4, 'big'))
+        if vers == 2:
+            f.write(wm.to_bytes(4, 'big'))
+        else:
+            f.write(bytes(4) + wm.to_bytes(8, 'big'))
+        f.write(slots.to_bytes(4, 'big') + len(keys).to_bytes(4, 'big'))
+        f.write(tbl)
+        f.write(bytes(4))
+    return keys
+
+@pytest.mark.parametrize('vers', [2, 3])
+def test_convert_slots(worm, vers):
+    keys = _legacy_keys_ht(worm, vers)
+    ndx = ssb.local.worm.SSB_WORM_INDEX(worm._keysHT._fname)
+    ndx.load_from_disk()
+    assert ndx.legacy
+    assert ndx.watermark == worm._keysHT.watermark
+    for k in keys:
+        assert worm.offsetOf(k) in list(ndx.offsets(k))
+
+@pytest.mark.parametrize('vers', [2, 3])
+def test_load_legacy_keys_ht(worm, vers):
+    keys = _legacy_keys_ht(worm, vers)
+    w = ssb.local.worm.SSB_WORM('Alice', ssb.local.config.SSB_SECRET('Alice'))
+    assert not w._keysHT.legacy # rehashed when loaded
+    for i, k in enumerate(reversed(keys)):
+        assert w.readMsg(k)['key'] == k
+        assert w.getMsgBySequence(w.id, i+1)['key'] == k
+    w.flush()
+    with open(w._keysHT._fname, 'rb') as f:
+        assert int.from_bytes(f.read(4), 'big') == 4
+    assert w.readMsg('%' + 'A'*43 + '=.sha256') is None
+
+def _foreign(worm):
+    return [ k for k in worm if worm.readMsg(k)['value']['author'] != worm.id ]
+
+def test_append_many_duplicates(worm):
+    msgs = _msgStrs('Bob', 3)
+    ids = worm.appendMany(msgs[:2])
+    assert None not in ids
+    # one already in the log, one twice in the same batch
+    ids2 = worm.appendMany([msgs[0], msgs[2], msgs[2]])
+    assert ids2[0] == ids[0] and ids2[1] == ids2[2]
+    assert len(_foreign(worm)) == 3
+    assert worm.readMsg(ids2[1])['value']['sequence'] == 3
+
+def test_append_many_verified(worm):
+    msgs = _msgStrs('Bob', 3)
+    ids = worm.appendMany(msgs, [True, False, True])
+    assert ids[1] is None
+    assert sorted(_foreign(worm)) == sorted([ids[0], ids[2]])
+    # without results, appendMany checks the signatures itself
+    assert worm.appendMany([_bad(msgs[1])]) == [None]
+    assert len(_foreign(worm)) == 2
+
+@pytest.mark.parametrize('durability', ['none', 'flush', 'fsync'])
+def test_durability(worm, monkeypatch, durability):
+    syncs = []
+    monkeypatch.setattr(ssb.local.worm.os, 'fsync',
+                        lambda fd: syncs.append(fd))
+    msgs = _msgStrs('Bob', 2)
+    w = ssb.local.worm.SSB_WORM('Alice', ssb.local.config.SSB_SECRET('Alice'),
+                                durability=durability)
+    size = os.path.getsize(w._logFname)
+    ids = w.appendMany(msgs)
+    # 'none' leaves the batch in our buffer, but reads still see it
+    assert (os.path.getsize(w._logFname) > size) == (durability != 'none')
+    assert len(syncs) == (1 if durability == 'fsync' else 0)
+    assert w.readMsg(ids[1])['key'] == ids[1]
+    w.flush()
+    assert os.path.getsize(w._logFname) == w._log.size
+
+def test_verifier_order(worm):
+    msgs = _msgStrs('Bob', 5)
+    msgs[1] = _bad(msgs[1])
+    msgs[4] = _bad(msgs[4])
+    expected = [True, False, True, True, False]
+    v = ssb.local.worm.SSB_VERIFIER(workers=3, chunk=2)
+    assert v.verify(msgs) == expected
+    assert asyncio.run(v.verify_async(msgs)) == expected
+    v.shutdown()
+
+def test_compact_bloom(worm):
+    # the Bloom filter chain is rebuilt as one filter
+    worm._bloom.reset()
+    worm._bloom.add('%' + 'A'*43 + '=.sha256') # a false positive
+    worm._bloom._filters.append( (bytearray(2), 1, 0) )
+    worm.compact()
+    assert len(worm._bloom._filters) == 1
+    assert worm._bloom.watermark == worm._keysHT.watermark
+    for k in worm:
+        assert worm._bloom.mightContain(k)
+    assert not worm._bloom.mightContain('%' + 'A'*43 + '=.sha256')
+
+def _truncate_log(worm, n):
+    # drop the last n records of the log, as if they were lost in a crash
+    worm.flush()
+    end = worm._log.size
+    for i in range(n):
+        end, _ = worm._log.recordBefore(end)
+    worm._log.close()
+    with open(worm._logFname, 'r+b') as f:
+        f.truncate(end)
+
+def test_index_beyond_log(worm):
+    lost = list(worm)[:2]
+    _truncate_log(worm, 2)
+    w = ssb.local.worm.SSB_WORM('Alice', ssb.local.config.SSB_SECRET('Alice'))
+    for ndx,_ in w._indexes:
+        assert ndx.watermark == w._log.size
+    for k in lost:
+        assert w.readMsg(k) is None
+    assert w._getMaxSeq()[1] == 18
+    k = w.writeMsg({ 'type': 'post', 'text': 'after the crash' })
+    assert w.getMsgBySequence(w.id, 19)['key'] == k
+
+def test_seqs_stale_entry(worm):
+    # a seqs slot pointing at another msg is not served
+    wrong = worm._seqs.offset(worm.id, 6)
+    worm._seqs.add(worm.id, 4, wrong)
+    assert worm.getMsgBySequence(worm.id, 4) is None
+    assert worm.getMsgBySequence(worm.id, 6)['value']['sequence'] == 6
+    assert worm.getMsgBySequence('@abc', 1) is None
+
+def test_index_torn_save(worm, monkeypatch):
+    # a crash while saving leaves the previous file intact
+    def crash(f, val):
+        f.write(val.to_bytes(4, byteorder='big'))
+        raise OSError("crash")
+    monkeypatch.setattr(ssb.local.worm, '_writeUInt32BE', crash)
+    def crash_json(d, f):
+        f.write('{')
+        raise OSError("crash")
+    monkeypatch.setattr(ssb.local.worm.json, 'dump', crash_json)
+    for ndx in [worm._keysHT, worm._bloom, worm._last]:
+        with open(ndx._fname, 'rb') as f:
+            before = f.read()
+        ndx.advance(ndx.watermark + 1)
+        with pytest.raises(OSError):
+            ndx.save_to_disk()
+        with open(ndx._fname, 'rb') as f:
+            assert f.read() == before
+
+def test_json_journal(tmp_path):
+    fname = os.path.join(str(tmp_path), 'view.json')
+    v = ssb.local.worm.SSB_WORM_JSONJOURNAL(fname)
+    v.load_from_disk()
+    for i in range(10):
+        v.value['k%d' % i] = i
+        v.touch('k%d' % i)
+        v.advance(100 + i)
+        v.flush()
+    assert not os.path.isfile(fname) # only the journal was written
+    v.value['k3'] = 'x'
+    v.touch('k3')
+    v.advance(200)
+    v.flush()
+    with open(fname + '.jnl', 'ab') as f:
+        f.write(b'{"jgen": 0, "seq": 300, "set"') # torn last line
+    w = ssb.local.worm.SSB_WORM_JSONJOURNAL(fname)
+    w.load_from_disk()
+    assert w.value == v.value and w.watermark == 200
+    assert os.path.getsize(fname + '.jnl') == w._jsize
+    # the file is rewritten once the journal outgrows it
+    w.COMPACT_MIN = 0
+    w.touch('k1')
+    w.flush()
+    assert os.path.isfile(fname) and os.path.getsize(fname + '.jnl') == 0
+    w = ssb.local.worm.SSB_WORM_JSONJOURNAL(fname)
+    w.load_from_disk()
+    assert w.value == v.value and w.watermark == 200
+
+def test_json_journal_stale(tmp_path):
+    # a crash after rewriting the file, before emptying the journal
+    fname = os.path.join(str(tmp_path), 'view.json')
+    v = ssb.local.worm.SSB_WORM_JSONJOURNAL(fname)
+    v.load_from_disk()
+    v.value['a'] = 1
+    v.touch('a')
+    v.advance(10)
+    v.flush()
+    with open(fname + '.jnl', 'rb') as f:
+        jnl = f.read()
+    v.value['a'] = 2
+    v.touch()
+    v.advance(20)
+    v.flush()
+    with open(fname + '.jnl', 'wb') as f:
+        f.write(jnl)
+    w = ssb.local.worm.SSB_WORM_JSONJOURNAL(fname)
+    w.load_from_disk()
+    assert w.value == { 'a': 2 } and w.watermark == 20
+
+# eof
@@ -2,16 +2,23 @@
 
 # ssb/local/worm.py
 
+import asyncio
 import base64
+import collections
+import concurrent.futures
 import copy
+import functools
 import json
 import hashlib
+import mmap
 import os
 import sys
+import tempfile
 import time
 
 from ssb.local.config import verify_signature, SSB_SECRET
 from ssb.local.util   import username2dir, is_locked, id2bytes
+import ssb.local.blobs
 
 # ---------------------------------------------------------------------------
 
@@ -49,62 +56,407 @@ def _readUInt32BE(f):
 def _writeUInt32BE(f, val):
     return f.write(val.to_bytes(4, byteorder='big'))
 
+_SLOT = 8 # bytes per hash table slot (v4 index format)
+COMPACT_TABLES = 4 # compact the keys index when it has more tables
+COMPACT_FILTERS = 2 # ... or when the Bloom filter chain is longer
+BLOB_CHUNK = 65536 # bytes per chunk when streaming blobs
+
+def _convert_slots(tbl, width):
+    # convert a table of v2 (width 4) or v3 (width 8) slots holding offs+1
+    # to v4 slots, with the fingerprint left empty: (offs+1) << 16
+    n = len(tbl) // width
+    wide = bytearray(_SLOT*n)
+    keep = min(width, _SLOT-2) # low order bytes of offs+1 that we keep
+    for j in range(keep):
+        wide[_SLOT-2-keep+j::_SLOT] = tbl[width-keep+j::width]
+    return wide
+
 def _hthash(key):
     key = key[1:7] + '=='
     return _UInt32BE(base64.b64decode(key))
 
-def _seq2key(key, seq):
-    data = hashlib.sha1( (str(seq)+key).encode('utf8') ).digest()
-    return '_' + base64.b64encode(data[:8]).decode('ascii')
+def _htfp(key):
+    # 16bit fingerprint from key bits that _hthash() does not use
+    return _UInt32BE(base64.b64decode(key[7:11])) & 0xffff
+
+def check_signature(msgStr):
+    # verify the signature of a formatted msg (msgStr), returns a bool
+    jmsg = json.loads(msgStr)
+    if not 'author' in jmsg or not 'signature' in jmsg:
+        raise ValueError
+    s = base64.b64decode( jmsg['signature'] )
+    i = msgStr.find(',\n  "signature":')
+    m = (msgStr[:i] + '\n}').encode('utf8')
+    # m = (msgStr[:i] + '\n}').encode('ascii')
+    return verify_signature(jmsg['author'], m, s)
+
+def _check_signatures(msgStrs):
+    return [check_signature(m) for m in msgStrs]
+
+def _reindex_progress(done, total):
+    if total < 1024*1024: # don't bother for small logs
+        return
+    sys.stderr.write("\r** reindexing log: %d%%" % (100 * done // total))
+    if done >= total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+# ---------------------------------------------------------------------------
+
+class SSB_WORM_RECORD:
+
+    # lightweight view on a log entry: key, author, sequence and content
+    # type are picked from the fixed layout that appendMany() writes,
+    # the JSON is only parsed (once) when the full msg is needed or when
+    # the entry has another layout (e.g. if written by other software)
+
+    _KEY  = b'{\n  "key": "'
+    _PREV = b'",\n  "value": {\n    "previous": '
+    _AUTH = b',\n    "author": "'
+    _SEQ  = b'",\n    "sequence": '
+    _CONT = b'\n    "content": '
+    _TYPE = b'\n      "type": "'
+
+    def __init__(self, data):
+        self._data = bytes(data)
+        self._msg = None
+        self._hdr = None
+
+    @property
+    def msg(self):
+        # the log entry as a Python dict
+        if self._msg is None:
+            self._msg = json.loads(self._data)
+        return self._msg
+
+    def _header(self):
+        # returns (key, author, sequence, content pos), or False
+        if self._hdr is not None:
+            return self._hdr
+        self._hdr = False
+        d = self._data
+        if not d.startswith(self._KEY):
+            return False
+        i = d.find(b'"', len(self._KEY))
+        key = d[len(self._KEY):i]
+        if not d.startswith(self._PREV, i):
+            return False
+        i += len(self._PREV)
+        if d.startswith(b'null', i):
+            i += 4
+        else:
+            i = d.find(b'"', i+1) + 1
+        if not d.startswith(self._AUTH, i):
+            return False
+        i += len(self._AUTH)
+        j = d.find(b'"', i)
+        auth = d[i:j]
+        if not d.startswith(self._SEQ, j):
+            return False
+        i = j + len(self._SEQ)
+        j = d.find(b',', i)
+        c = d.find(self._CONT, j)
+        if c < 0 or not d[i:j].isdigit():
+            return False
+        self._hdr = (key.decode('ascii'), auth.decode('ascii'), int(d[i:j]),
+                     c + len(self._CONT))
+        return self._hdr
+
+    @property
+    def key(self):
+        h = self._header()
+        return h[0] if h else self.msg['key']
+
+    @property
+    def author(self):
+        h = self._header()
+        return h[1] if h else self.msg['value']['author']
+
+    @property
+    def sequence(self):
+        h = self._header()
+        return h[2] if h else self.msg['value']['sequence']
+
+    @property
+    def contentType(self):
+        # the content's 'type' field, None for private (string) content
+        h = self._header()
+        if h:
+            c = h[3]
+            if self._data[c:c+1] != b'{':
+                return None
+            i = self._data.find(self._TYPE, c)
+            if i < 0:
+                return None
+            i += len(self._TYPE)
+            j = self._data.find(b'"', i)
+            t = self._data[i:j]
+            if not b'\\' in t:
+                return t.decode('utf8')
+        c = self.msg['value']['content']
+        return c.get('type') if isinstance(c, dict) else None
+
+# ---------------------------------------------------------------------------
+
+class SSB_VERIFIER:
+
+    # checks signatures of msg batches in a pool of workers (libsodium
+    # releases the GIL, so threads scale), results keep the batch order
+
+    def __init__(self, workers=None, processes=False, chunk=64):
+        if not workers:
+            workers = os.cpu_count() or 1
+        if processes:
+            self._pool = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self._chunk = chunk
+
+    def _chunks(self, msgStrs):
+        return [msgStrs[i:i+self._chunk]
+                              for i in range(0, len(msgStrs), self._chunk)]
+
+    def verify(self, msgStrs):
+        # returns a list of bools, one per msg
+        ok = []
+        for r in self._pool.map(_check_signatures, self._chunks(msgStrs)):
+            ok += r
+        return ok
+
+    async def verify_async(self, msgStrs):
+        # same as verify(), without blocking the event loop
+        loop = asyncio.get_event_loop()
+        res = await asyncio.gather(*[
+                      loop.run_in_executor(self._pool, _check_signatures, c)
+                                          for c in self._chunks(msgStrs) ])
+        ok = []
+        for r in res:
+            ok += r
+        return ok
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+# ---------------------------------------------------------------------------
+
+class SSB_WORM_LOG:
+
+    # memory-mapped access to log.offset: records are served as memoryview
+    # slices of the mapping, appends go through one persistent write handle
+    #
+    # record layout: UInt32BE(sz) + data + UInt32BE(sz) + UInt32BE(end)
+    # where 'end' is only kept modulo 2^32 (the format has no room for
+    # more): all navigation uses the size fields, so logs can grow >4GiB
+    #
+    # durability policy, applied once per appended batch:
+    #   'none'  : leave the batch in our write buffer (it is pushed out
+    #             before the next read that needs it, or by sync())
+    #   'flush' : hand the batch to the OS
+    #   'fsync' : force the batch to disk
+
+    def __init__(self, fname, readonly=False, durability='flush'):
+        if not durability in ['none', 'flush', 'fsync']:
+            raise ValueError("unknown durability policy %s" % durability)
+        self._fname = fname
+        self._f = open(fname, 'rb' if readonly else 'r+b')
+        self._map = None
+        self._view = None
+        self._mapped = 0
+        self._pending = False # buffered bytes not yet written to the file
+        self.durability = durability
+        self.size = 0
+        self.remap()
+
+    def remap(self):
+        # (re)map the whole file, e.g. after it was extended
+        if self._pending:
+            self._f.flush()
+            self._pending = False
+        self.size = os.fstat(self._f.fileno()).st_size
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError: # slices still exported, let gc unmap it
+                pass
+            self._map = None
+        self._mapped = self.size
+        if self.size > 0:
+            self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+
+    def _need(self, end):
+        # make sure that bytes up to 'end' are mapped
+        if end <= self._mapped:
+            return True
+        self.remap()
+        return end <= self._mapped
+
+    def record(self, pos):
+        # returns the data of the record starting at pos (a memoryview)
+        if pos < 0 or not self._need(pos + 4):
+            return None
+        sz = _UInt32BE(self._view[pos:pos+4])
+        if not self._need(pos + 12 + sz):
+            return None
+        return self._view[pos+4:pos+4+sz]
+
+    def recordBefore(self, end):
+        # returns (pos, data) of the record ending at 'end', or (None, None)
+        if end < 12 or not self._need(end):
+            return (None, None)
+        sz = _UInt32BE(self._view[end-8:end-4])
+        pos = end - 12 - sz
+        if pos < 0:
+            return (None, None)
+        return (pos, self._view[pos+4:pos+4+sz])
+
+    def records(self, pos=0):
+        # iterate forward over (pos, data) of all complete records from pos
+        while True:
+            m = self.record(pos)
+            if m is None:
+                return
+            yield (pos, m)
+            pos += len(m) + 12
+
+    def append(self, data):
+        # append one record, returns its position in the log
+        return self.appendMany([data])[0]
+
+    def appendMany(self, datas):
+        # append a batch of records with a single write,
+        # returns the list of their positions in the log
+        buf = bytearray()
+        offsets = []
+        for data in datas:
+            offsets.append(self.size + len(buf))
+            sz = len(data).to_bytes(4, byteorder='big')
+            buf += sz
+            buf += data
+            buf += sz
+            end = self.size + len(buf) + 4
+            buf += (end & 0xffffffff).to_bytes(4, byteorder='big')
+        if not self._pending:
+            self._f.seek(self.size, os.SEEK_SET)
+        self._f.write(buf)
+        self.size += len(buf)
+        self._pending = True
+        if self.durability != 'none':
+            self.sync()
+        return offsets
+
+    def sync(self):
+        # push buffered appends to the OS (and to disk, if so configured)
+        if self._pending:
+            self._f.flush()
+            self._pending = False
+            if self.durability == 'fsync':
+                os.fsync(self._f.fileno())
+
+    def close(self):
+        self.sync()
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._map = None
+        self._mapped = 0
+        self._f.close()
 
 # ---------------------------------------------------------------------------
 
 class SSB_WORM_INDEX:
 
+    # chain of open-addressing hash tables, stored in a file as
+    #   v4 header: UInt32BE(4) + UInt32BE(0) + UInt64BE(watermark)
+    #   per table: UInt32BE(slots) + UInt32BE(cnt) + slots * UInt64BE(slot)
+    # where slot = (offs+1) << 16 | fingerprint of the key (see _htfp),
+    # which lets lookups skip most colliding entries without a log read.
+    # v2 (UInt32BE offs+1) and v3 (UInt64BE offs+1) files are converted
+    # when loaded, but lack fingerprints until rehashed (see legacy)
+
     def __init__(self, fname, readonly=False):
         # print('worm index is', fname)
         self._fname = fname
         if not os.path.isfile(self._fname):
             if readonly:
                 raise Exception("no file", fname)
-            with open(self._fname, 'wb') as ndx:
-                _writeUInt32BE(ndx, 2) # vers
-                _writeUInt32BE(ndx, 0) # seq?
-                slots = 64*1024
-                _writeUInt32BE(ndx, slots)
-                _writeUInt32BE(ndx, 0) # cnt
-                ndx.write(bytes(4*slots))
+            self.reset()
+            self.save_to_disk()
         self._ndxTables = []
         self._ndxDirty = False
         self._count = 0
+        self.legacy = False # True if slots have no fingerprints yet
+        self.watermark = 0 # log position up to which entries were added
 
     def load_from_disk(self):
         # read index table into memory
         self._ndxTables = []
         self._count = 0
         with open(self._fname, 'rb') as ndx:
-            self._ndxHdr = ndx.read(8)
+            hdr = ndx.read(8)
+            vers = _UInt32BE(hdr[:4])
+            if vers == 2:
+                self.watermark = _UInt32BE(hdr[4:8])
+            else:
+                self.watermark = _UInt32BE(ndx.read(8))
             while True:
                 slots = _readUInt32BE(ndx)
                 if slots == 0:
                     break
                 cnt = _readUInt32BE(ndx)
                 # print(slots, cnt)
-                tbl = ndx.read(slots * 4)
-                self._ndxTables.append( (bytearray(tbl),slots,cnt) )
+                if vers == 2:
+                    tbl = _convert_slots(ndx.read(slots * 4), 4)
+                elif vers == 3:
+                    tbl = _convert_slots(ndx.read(slots * 8), 8)
+                else:
+                    tbl = bytearray(ndx.read(slots * _SLOT))
+                self._ndxTables.append( (tbl,slots,cnt) )
                 self._count += cnt
-        self._ndxDirty = False
+        self.legacy = vers < 4 and self._count > 0
+        self._ndxDirty = vers != 4
+        if self._count > 0 and self.watermark == 0:
+            # written before watermarks were kept: coverage is unknown
+            self.reset()
 
     def save_to_disk(self):
-        # write back changed hash table (keys.ht)
-        with open(self._fname, 'wb') as ndx:
-            ndx.write(self._ndxHdr)
+        # write back changed hash table (keys.ht), replaced by rename:
+        # a torn file must not claim coverage up to its watermark
+        tmp = self._fname + '.tmp'
+        with open(tmp, 'wb') as ndx:
+            _writeUInt32BE(ndx, 4) # vers
+            _writeUInt32BE(ndx, 0)
+            ndx.write(self.watermark.to_bytes(8, byteorder='big'))
             for (tbl, slots, cnt) in self._ndxTables:
                 _writeUInt32BE(ndx, slots)
                 _writeUInt32BE(ndx, cnt)
                 ndx.write(tbl)
+        os.replace(tmp, self._fname)
         self._ndxDirty = False
 
+    def reset(self):
+        # drop all entries, the index has to be rebuilt from the log
+        slots = 64*1024
+        self._ndxTables = [ (bytearray(_SLOT*slots), slots, 0) ]
+        self._count = 0
+        self.legacy = False
+        self.watermark = 0
+        self._ndxDirty = True
+
+    def advance(self, pos):
+        # all log entries before pos have been added
+        if pos != self.watermark:
+            self.watermark = pos
+            self._ndxDirty = True
+
     def add(self, key, offs):
         # add 'key at offs' to the hash table (key is a string), flag as dirty
         (tbl,slots,cnt) = self._ndxTables[-1]
@@ -112,15 +464,16 @@ class SSB_WORM_INDEX:
         if cnt >= 0.5*slots:
             slots *= 2
             cnt = 0
-            tbl = bytearray(4*slots)
+            tbl = bytearray(_SLOT*slots)
             self._ndxTables.append( (tbl, slots, cnt) )
         # find free ht entry
         pos = _hthash(key) % slots
         while True:
             pos1 = pos+1
-            val = _UInt32BE(tbl[pos*4:pos1*4])
+            val = _UInt32BE(tbl[pos*_SLOT:pos1*_SLOT])
             if val == 0:
-                tbl[pos*4:pos1*4] = (offs+1).to_bytes(4, byteorder='big')
+                val = (offs+1) << 16 | _htfp(key)
+                tbl[pos*_SLOT:pos1*_SLOT] = val.to_bytes(_SLOT, byteorder='big')
                 self._ndxTables[-1] = (tbl,slots,cnt+1)
                 self._ndxDirty = True
                 self._count += 1
@@ -129,17 +482,498 @@ class SSB_WORM_INDEX:
         raise Exception('internal error in hash table')
 
     def offsets(self, key):
-        return SSB_WORM_INDEX_ITER(self._ndxTables, key)
+        # candidate log offsets for key (all of them for legacy tables)
+        return SSB_WORM_INDEX_ITER(self._ndxTables, key,
+                                   None if self.legacy else _htfp(key))
+
+    def compact(self, keyAt):
+        # rehash all tables into a single one, keyAt(offs) returns the
+        # key of the log entry at offs (the tables only hold offsets).
+        # This also adds the fingerprints to legacy tables.
+        slots = 64*1024
+        while slots < 4*self._count:
+            slots *= 2
+        tables = self._ndxTables
+        self._ndxTables = [ (bytearray(_SLOT*slots), slots, 0) ]
+        self._count = 0
+        for tbl,_,_ in tables:
+            for v in memoryview(tbl).cast('Q'): # only tested for zero
+                if v != 0:
+                    offs = (_UInt32BE(v.to_bytes(8, sys.byteorder)) >> 16) - 1
+                    self.add(keyAt(offs), offs)
+        self.legacy = False
+        self._ndxDirty = True
+
+    def stats(self):
+        # returns a dict with the table sizes and the number of probes
+        # a miss costs, per table (avg, max) and in total (avg)
+        tables = []
+        miss = 0
+        for tbl, slots, cnt in self._ndxTables:
+            occ = [ v != 0 for v in memoryview(tbl).cast('Q') ]
+            # a miss starting in a run of L used slots probes L+1 slots
+            if all(occ):
+                runs = [slots]
+            else:
+                i = occ.index(False) # start at an empty slot (wrap-around)
+                runs = []
+                run = 0
+                for j in range(1, slots+1):
+                    if occ[(i+j) % slots]:
+                        run += 1
+                    elif run > 0:
+                        runs.append(run)
+                        run = 0
+            total = slots + sum([ r*(r+1)//2 for r in runs ])
+            avg = total / slots
+            miss += avg
+            tables.append({ 'slots': slots, 'count': cnt,
+                            'load': cnt / slots,
+                            'miss_avg': avg,
+                            'miss_max': max(runs + [0]) + 1 })
+        return { 'count': self._count, 'tables': tables, 'miss_avg': miss }
 
     def flush(self):
         if not self._ndxDirty:
             return
         self.save_to_disk()
 
+class SSB_WORM_BLOOM:
+
+    # chain of Bloom filters over msg keys, each new filter has twice the
+    # capacity of the previous one (a scalable Bloom filter). Each filter
+    # adds its false positives, so the chain is rebuilt as one filter
+    # when the keys index is compacted (see SSB_WORM.compact). Stored as
+    #   header:     UInt32BE(1) + UInt32BE(k) + UInt64BE(watermark)
+    #   per filter: UInt32BE(capacity) + UInt32BE(cnt) + capacity*BITS/8 bytes
+
+    BITS = 10 # bits per key, for a false positive rate of about 1%
+    K = 7     # number of hash functions
+
+    def __init__(self, fname, readonly=False):
+        self._fname = fname
+        self._readonly = readonly
+        self._filters = []
+        self._dirty = False
+        self.watermark = 0
+
+    def load_from_disk(self):
+        self.reset()
+        self._dirty = False
+        if not os.path.isfile(self._fname):
+            return
+        with open(self._fname, 'rb') as f:
+            hdr = f.read(16)
+            if _UInt32BE(hdr[:4]) != 1 or _UInt32BE(hdr[4:8]) != self.K:
+                self._dirty = True # unknown format: rebuild
+                return
+            self.watermark = _UInt32BE(hdr[8:16])
+            self._filters = []
+            while True:
+                cap = _readUInt32BE(f)
+                if cap == 0:
+                    break
+                cnt = _readUInt32BE(f)
+                bits = bytearray(f.read(cap * self.BITS // 8))
+                self._filters.append( (bits, cap, cnt) )
+
+    def save_to_disk(self):
+        # replaced by rename (a torn filter would give false negatives)
+        tmp = self._fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            _writeUInt32BE(f, 1)
+            _writeUInt32BE(f, self.K)
+            f.write(self.watermark.to_bytes(8, byteorder='big'))
+            for bits, cap, cnt in self._filters:
+                _writeUInt32BE(f, cap)
+                _writeUInt32BE(f, cnt)
+                f.write(bits)
+        os.replace(tmp, self._fname)
+        self._dirty = False
+
+    def reset(self, cap=64*1024):
+        self._filters = [ (bytearray(cap * self.BITS // 8), cap, 0) ]
+        self.watermark = 0
+        self._dirty = True
+
+    def advance(self, pos):
+        if pos != self.watermark:
+            self.watermark = pos
+            self._dirty = True
+
+    def _hashes(self, key):
+        # keys are sha256 values already: derive the bit positions from
+        # two 64bit slices of it (double hashing)
+        try:
+            d = id2bytes(key)
+        except:
+            d = b''
+        if len(d) < 16:
+            d = hashlib.sha256(key.encode('utf8')).digest()
+        h1 = int.from_bytes(d[:8], byteorder='big')
+        h2 = int.from_bytes(d[8:16], byteorder='big') | 1
+        return [ h1 + i*h2 for i in range(self.K) ]
+
+    def add(self, key):
+        bits, cap, cnt = self._filters[-1]
+        if cnt >= cap:
+            cap *= 2
+            cnt = 0
+            bits = bytearray(cap * self.BITS // 8)
+            self._filters.append( (bits, cap, cnt) )
+        n = cap * self.BITS
+        for h in self._hashes(key):
+            h %= n
+            bits[h >> 3] |= 1 << (h & 7)
+        self._filters[-1] = (bits, cap, cnt+1)
+        self._dirty = True
+
+    def mightContain(self, key):
+        # False means that the key is definitely not in the log
+        hs = self._hashes(key)
+        for bits, cap, _ in self._filters:
+            n = cap * self.BITS
+            for h in hs:
+                h %= n
+                if not bits[h >> 3] & (1 << (h & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def flush(self):
+        if not self._dirty or self._readonly:
+            return
+        self.save_to_disk()
+
+
+class SSB_WORM_SEQS:
+
+    # dense per-author sequence index: for each author an append-only
+    # array of log offsets, indexed by sequence number, in the file
+    # flume/seqs/<hex of the author's public key>
+    #
+    # slot i holds UInt64BE(offs+1) of sequence number i+1, 0 if unknown
+    #
+    # slots are read with pread(), at most MAX_OPEN files are kept open
+    # (least recently used ones are closed): there can be many authors
+
+    MAX_OPEN = 64
+
+    def __init__(self, dname, readonly=False):
+        self._dname = dname
+        if not os.path.isdir(self._dname):
+            if readonly:
+                raise Exception("no directory", dname)
+            os.makedirs(self._dname)
+        self._wmFname = os.path.join(self._dname, 'watermark')
+        self._readonly = readonly
+        self._feeds = {}
+        self._fds = collections.OrderedDict() # fname -> fd, in LRU order
+        self._dirty = False
+        self.watermark = 0
+
+    def _fname(self, author):
+        # None for a malformed feed id
+        try:
+            pk = id2bytes(author)
+        except:
+            return None
+        if len(pk) != 32:
+            return None
+        return os.path.join(self._dname, pk.hex())
+
+    def _feed(self, author, create=False):
+        f = self._feeds.get(author)
+        if not f:
+            fname = self._fname(author)
+            if not fname or not (create or os.path.isfile(fname)):
+                return None
+            f = SSB_WORM_SEQS_FEED(fname, self._pread)
+            self._feeds[author] = f
+        return f
+
+    def _pread(self, fname, n, pos):
+        fd = self._fds.pop(fname, None)
+        if fd is None:
+            fd = os.open(fname, os.O_RDONLY)
+            while len(self._fds) >= self.MAX_OPEN:
+                os.close(self._fds.popitem(last=False)[1])
+        self._fds[fname] = fd
+        return os.pread(fd, n, pos)
+
+    def _close_all(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+    def load_from_disk(self):
+        self._close_all()
+        self._feeds = {}
+        self.watermark = 0
+        if os.path.isfile(self._wmFname):
+            with open(self._wmFname, 'rb') as f:
+                self.watermark = int.from_bytes(f.read(8), byteorder='big')
+        self._dirty = False
+
+    def save_to_disk(self):
+        for f in self._feeds.values():
+            f.flush()
+        # the watermark goes last: after a crash, we re-add (idempotent)
+        tmp = self._wmFname + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.watermark.to_bytes(8, byteorder='big'))
+        os.replace(tmp, self._wmFname)
+        self._dirty = False
+
+    def reset(self):
+        self.load_from_disk()
+        for fn in os.listdir(self._dname):
+            os.remove(os.path.join(self._dname, fn))
+        self.watermark = 0
+        self._dirty = True
+
+    def advance(self, pos):
+        if pos != self.watermark:
+            self.watermark = pos
+            self._dirty = True
+
+    def add(self, author, seq, offs):
+        if seq < 1:
+            return
+        f = self._feed(author, create=True)
+        if f:
+            f.set(seq-1, offs)
+            self._dirty = True
+
+    def offset(self, author, seq):
+        # returns the log offset of the author's msg, or None
+        if seq < 1:
+            return None
+        f = self._feed(author)
+        return f.get(seq-1) if f else None
+
+    def flush(self):
+        if not self._dirty or self._readonly:
+            return
+        self.save_to_disk()
+
+
+class SSB_WORM_SEQS_FEED:
+
+    # one author's offset array: slots in the file are read with the
+    # given pread function, slots added since the last flush are kept
+    # in memory
+
+    def __init__(self, fname, pread):
+        self._fname = fname
+        self._pread = pread
+        self._patch = {}     # slot -> offs+1, for slots in the file
+        self._tail = bytearray() # slots beyond the file
+        self._slots = 0      # number of slots in the file
+        if os.path.isfile(self._fname):
+            self._slots = os.path.getsize(self._fname) // 8
+
+    def _raw(self, i):
+        if i in self._patch:
+            return self._patch[i]
+        if i < self._slots:
+            return int.from_bytes(self._pread(self._fname, 8, 8*i),
+                                  byteorder='big')
+        i -= self._slots
+        if 8*i+8 <= len(self._tail):
+            return int.from_bytes(self._tail[8*i:8*i+8], byteorder='big')
+        return 0
+
+    def get(self, i):
+        v = self._raw(i)
+        return v-1 if v else None
+
+    def set(self, i, offs):
+        if self._raw(i) == offs+1:
+            return
+        if i < self._slots:
+            self._patch[i] = offs+1
+            return
+        i -= self._slots
+        if 8*i+8 > len(self._tail):
+            self._tail += bytes(8*i+8 - len(self._tail))
+        self._tail[8*i:8*i+8] = (offs+1).to_bytes(8, byteorder='big')
+
+    def flush(self):
+        if len(self._patch) == 0 and len(self._tail) == 0:
+            return
+        # written in place: an fd held open for pread sees the new slots
+        with open(self._fname, 'r+b' if self._slots > 0 else 'wb') as f:
+            for i, v in self._patch.items():
+                f.seek(8*i, os.SEEK_SET)
+                f.write(v.to_bytes(8, byteorder='big'))
+            f.seek(8*self._slots, os.SEEK_SET)
+            f.write(self._tail)
+            self._slots = f.tell() // 8
+        self._patch = {}
+        self._tail = bytearray()
+
+
+class SSB_WORM_JSONVIEW:
+
+    # a view kept as a JSON file in the flume directory, with the same
+    # layout as flume's views: { 'version': v, 'seq': pos, 'value': ... }
+    # where 'seq' is the log position up to which entries were processed
+
+    def __init__(self, fname, version=1, readonly=False):
+        self._fname = fname
+        self._version = version
+        self._readonly = readonly
+        self._dirty = False
+        self.reset()
+        self._dirty = False
+
+    def reset(self):
+        self.data = {
+            'version': self._version,
+            'value': {},
+            'seq': 0
+        }
+        self._dirty = True
+
+    @property
+    def value(self):
+        return self.data['value']
+
+    @property
+    def watermark(self):
+        return self.data['seq']
+
+    def load_from_disk(self):
+        self.reset()
+        self._dirty = False
+        if os.path.isfile(self._fname):
+            with open(self._fname, "rb") as f:
+                self.data = json.load(f)
+        if self.data['seq'] == 0 and len(self.data['value']) > 0:
+            # written before watermarks were kept: coverage is unknown
+            self.reset()
+
+    def save_to_disk(self):
+        tmp = self._fname + '.tmp'
+        with open(tmp, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self._fname)
+        self._dirty = False
+
+    def advance(self, pos):
+        if pos != self.data['seq']:
+            self.data['seq'] = pos
+            self._dirty = True
+
+    def touch(self):
+        self._dirty = True
+
+    def flush(self):
+        if not self._dirty or self._readonly:
+            return
+        self.save_to_disk()
+
+
+class SSB_WORM_JSONJOURNAL(SSB_WORM_JSONVIEW):
+
+    # a JSON view whose value maps keys to entries of which only a few
+    # change at a time: touch(key) marks an entry, and flush() appends
+    # the marked ones to a journal (fname + '.jnl'), one JSON line
+    #   { 'jgen': g, 'seq': pos, 'set': { key: entry, .. } }
+    # The JSON file is rewritten (and the journal emptied) when the
+    # journal grows larger than the file. Lines of an older generation
+    # (a crash before the journal was emptied) and a partial last line
+    # are ignored.
+
+    COMPACT_MIN = 64*1024 # journal bytes below which it's never compacted
+
+    def __init__(self, fname, version=1, readonly=False):
+        self._jfname = fname + '.jnl'
+        self._changed = set()
+        self._moved = False
+        self._size = 0  # of the JSON file
+        self._jsize = 0 # of the journal
+        super().__init__(fname, version, readonly)
+
+    def reset(self):
+        super().reset()
+        self.data['jgen'] = 0
+        self._changed = set()
+        self._moved = False
+
+    def load_from_disk(self):
+        super().load_from_disk()
+        self._size = os.path.getsize(self._fname) \
+                                      if os.path.isfile(self._fname) else 0
+        self._jsize = 0
+        if not os.path.isfile(self._jfname):
+            return
+        with open(self._jfname, "rb") as f:
+            buf = f.read()
+        for line in buf.split(b'\n')[:-1]:
+            try:
+                j = json.loads(line)
+            except ValueError:
+                break
+            if j['jgen'] == self.data.get('jgen', 0):
+                self.data['value'].update(j['set'])
+                self.data['seq'] = j['seq']
+            self._jsize += len(line) + 1
+        if self._jsize != len(buf) and not self._readonly:
+            # partially written line (crash): drop it
+            with open(self._jfname, "r+b") as f:
+                f.truncate(self._jsize)
+
+    def save_to_disk(self):
+        self.data['jgen'] = self.data.get('jgen', 0) + 1
+        super().save_to_disk()
+        with open(self._jfname, "wb"):
+            pass
+        self._size = os.path.getsize(self._fname)
+        self._jsize = 0
+        self._changed = set()
+        self._moved = False
+
+    def advance(self, pos):
+        if pos != self.data['seq']:
+            self.data['seq'] = pos
+            self._moved = True
+
+    def touch(self, key=None):
+        # key None: the whole view changed
+        if key is None:
+            self._dirty = True
+        else:
+            self._changed.add(key)
+
+    def flush(self):
+        if self._readonly:
+            return
+        if self._dirty or self._jsize > max(self._size, self.COMPACT_MIN):
+            self.save_to_disk()
+            return
+        if len(self._changed) == 0 and not self._moved:
+            return
+        line = json.dumps({
+            'jgen': self.data['jgen'],
+            'seq':  self.data['seq'],
+            'set':  { k: self.value[k] for k in self._changed }
+        }).encode('utf8') + b'\n'
+        with open(self._jfname, "ab") as f:
+            f.write(line)
+        self._jsize += len(line)
+        self._changed = set()
+        self._moved = False
+
+
 class SSB_WORM_INDEX_ITER():
 
-    def __init__(self, ndxTables, key):
+    def __init__(self, ndxTables, key, fp=None):
+        # fp: fingerprint which the slots must match, None for any
         self.h = _hthash(key)
+        self.fp = fp
         self.tlst = copy.copy(ndxTables)
         self.tbl, self.slots,_ = self.tlst.pop()
         self.pos = self.h % self.slots
@@ -150,10 +984,12 @@ class SSB_WORM_INDEX_ITER():
     def __next__(self):
         while True:
             pos1 = self.pos + 1
-            offs = _UInt32BE(self.tbl[self.pos*4:pos1*4])
+            val = _UInt32BE(self.tbl[self.pos*_SLOT:pos1*_SLOT])
             self.pos = pos1 % self.slots
-            if offs != 0:
-                return offs-1
+            if val != 0:
+                if self.fp is None or val & 0xffff == self.fp:
+                    return (val >> 16) - 1
+                continue
             if len(self.tlst) == 0:
                 break
             self.tbl, self.slots,_ = self.tlst.pop()
@@ -162,18 +998,71 @@ class SSB_WORM_INDEX_ITER():
 
 # ---------------------------------------------------------------------------
 
+class SSB_WORM_BLOB_WRITER:
+
+    # streams a blob into a temp file while hashing it; commit() hands it
+    # to the blob store (see ssb/local/blobs.py), abort() discards it
+
+    def __init__(self, store, fsync=False, done=None):
+        # done: fct(hexhash, size), called after commit
+        self._store = store
+        self._fsync = fsync
+        self._done = done
+        os.makedirs(store.tmpDname, exist_ok=True)
+        fd, self._tmpName = tempfile.mkstemp(dir=store.tmpDname)
+        self._f = os.fdopen(fd, "wb")
+        self._h = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._f.write(data)
+        self._h.update(data)
+        self.size += len(data)
+
+    @property
+    def key(self):
+        return '&' + base64.b64encode(self._h.digest()).decode('ascii')
+
+    def commit(self):
+        self._f.flush()
+        if self._fsync:
+            os.fsync(self._f.fileno())
+        self._f.close()
+        self._store.store(self._tmpName, self._h.hexdigest())
+        if self._done:
+            self._done(self._h.hexdigest(), self.size)
+        return self.key
+
+    def abort(self):
+        self._f.close()
+        os.remove(self._tmpName)
+
+
 class SSB_WORM:
 
-    def __init__(self, username, secret, readonly = False):
+    def __init__(self, username, secret, readonly = False, progress = None,
+                 durability = 'flush',
+                 cacheEntries = 4096, cacheBytes = 16*1024*1024):
+        # progress: fct(done, total), called while indexes are rebuilt
+        # durability: 'none', 'flush' or 'fsync' per appended batch
+        # cacheEntries, cacheBytes: bounds for the LRU cache of readMsg()
         self._secr = secret
         self.id = self._secr.id
         self._on_extend = None
+        self._cache = collections.OrderedDict() # key -> (msg, size)
+        self._cacheBytes = 0
+        self._cacheMaxEntries = cacheEntries
+        self._cacheMaxBytes = cacheBytes
+        self.cacheHits = 0
+        self.cacheMisses = 0
         dir = username2dir(username)
-        self._blobDname = os.path.join(dir, 'blobs', 'sha256')
-        if not os.path.isdir(self._blobDname):
-            if readonly:
-                raise Exception("no blob directory")
-            os.makedirs(self._blobDname)
+        self._blobs = ssb.local.blobs.open_blobs(os.path.join(dir, 'blobs'),
+                                        readonly, durability == 'fsync')
+        self._blobCache = ssb.local.blobs.SSB_BLOBS_CACHE(
+                                        os.path.join(dir, 'blobs'), readonly)
+        # fct() returning the hex hashes of fetched blobs that must not be
+        # evicted from the blob cache, set by the application
+        self.blobPins = None
         self._logDname = os.path.join(dir, 'flume')
         if not os.path.isdir(self._logDname):
             if readonly:
@@ -187,132 +1076,147 @@ class SSB_WORM:
             with open(self._logFname, "wb") as f:
                 f.write(bytes(0))
         self._readonly = readonly;
-        self._log = open(self._logFname, 'rb' if readonly else 'r+b')
+        self._log = SSB_WORM_LOG(self._logFname, readonly, durability)
 
-        self._keysHT = SSB_WORM_INDEX(os.path.join(self._logDname, 'keys.ht'),
-                                      readonly)
-        self._keysHT.load_from_disk() # loadKeysHT()
-        if self._keysHT._count == 0:
-            self._reindexKeysHT()
+        self._progress = progress if progress else _reindex_progress
 
-        self._seqsHT = SSB_WORM_INDEX(os.path.join(self._logDname, 'seqs.ht'),
+        self._keysHT = SSB_WORM_INDEX(os.path.join(self._logDname, 'keys.ht'),
                                       readonly)
-        self._seqsHT.load_from_disk() # loadSeqsHT()
-        if self._seqsHT._count == 0:
-            self._reindexSeqsHT()
-
-        self._lastFname = os.path.join(self._logDname, 'last.json')
-        if not os.path.isfile(self._lastFname):
-            self._reindexLast()
-            with open(self._lastFname, "w") as f:
-                json.dump(self._last, f)
-        else:
-            with open(self._lastFname, "rb") as f:
-                self._last = json.load(f)
+        self._seqs = SSB_WORM_SEQS(os.path.join(self._logDname, 'seqs'),
+                                   readonly)
+        # superseded by the dense sequence index, resp. by tangle_tips.json
+        for fn in ['seqs.ht', 'tangles.json']:
+            fn = os.path.join(self._logDname, fn)
+            if not readonly and os.path.isfile(fn):
+                os.remove(fn)
+        self._last = SSB_WORM_JSONVIEW(os.path.join(self._logDname,
+                                                    'last.json'),
+                                       readonly=readonly)
+        self._bloom = SSB_WORM_BLOOM(os.path.join(self._logDname,
+                                                  'keys.bloom'), readonly)
+        # all indexes with their indexer fct, in the order they are fed
+        self._indexes = [ (self._keysHT, self._indexKey),
+                          (self._bloom,  self._indexBloom),
+                          (self._seqs,   self._indexSeq),
+                          (self._last,   self._indexLast) ]
+        self._attached = {} # fname -> application index
+        self._load_indexes()
+        self.flush()
 
         # read latest (msgId,seqNo) from the log
         # self._maxSeq = self._getMaxSeq(self.id)
 
-    def _reindexKeysHT(self):
-        # print("reindexing")
-        self._log.seek(0, os.SEEK_END)
-        offs = self._log.tell() - 4
-        while offs > 3:
-            self._log.seek(offs - 4, os.SEEK_SET)
-            sz = _readUInt32BE(self._log)
-            self._log.seek(-4 - sz, os.SEEK_CUR)
-            m = self._log.read(sz)
-            offs -= sz + 12
-            m = json.loads(m)
-            self._keysHT.add(m['key'], offs+4)
-
-    def _reindexSeqsHT(self):
-        # print("reindexing")
-        self._log.seek(0, os.SEEK_END)
-        offs = self._log.tell() - 4
-        while offs > 3:
-            self._log.seek(offs - 4, os.SEEK_SET)
-            sz = _readUInt32BE(self._log)
-            self._log.seek(-4 - sz, os.SEEK_CUR)
-            m = self._log.read(sz)
-            offs -= sz + 12
-            v = json.loads(m)['value']
-            self._seqsHT.add(_seq2key(v['author'], v['sequence']), offs+4)
-
-    def _reindexLast(self):
-        # print("reindexing")
+    # indexers are called with the log position and a SSB_WORM_RECORD
+
+    def _indexKey(self, offs, rec):
+        self._keysHT.add(rec.key, offs)
+
+    def _indexBloom(self, offs, rec):
+        self._bloom.add(rec.key)
+
+    def _indexSeq(self, offs, rec):
+        self._seqs.add(rec.author, rec.sequence, offs)
+
+    def _indexLast(self, offs, rec):
         ts = 0
-        self._last = {
-            'version': 1,
-            'value': {},
-            'seq': 0
-        }
-        self._log.seek(0, os.SEEK_END)
-        while self._log.tell() > 8:
-            self._log.seek(-8, os.SEEK_CUR)
-            sz = _readUInt32BE(self._log)
-            self._log.seek(-4 - sz, os.SEEK_CUR)
-            msg = self._log.read(sz)
-            if msg is None:
-                break
-            msg = json.loads(msg.decode('utf8'))
-            a = msg['value']['author']
-            if a in self._last['value']:
-                r = self._last['value'][a]
-            else:
-                r = { 'sequence': 0 }
-                self._last['value'][a] = r
-            if r['sequence'] < msg['value']['sequence']:
-                r['sequence'] = msg['value']['sequence']
-                r['id'] = msg['key']
-                r['ts'] = ts
-            self._log.seek(-4 - sz, os.SEEK_CUR)
+        a = rec.author
+        if a in self._last.value:
+            r = self._last.value[a]
+        else:
+            r = { 'sequence': 0 }
+            self._last.value[a] = r
+        if r['sequence'] < rec.sequence:
+            r['sequence'] = rec.sequence
+            r['id'] = rec.key
+            r['ts'] = ts
+
+    def attachIndex(self, fname, cls):
+        # add an application index, kept in the flume directory as fname
+        # and fed like the built-in ones. cls(path, readonly=..) must
+        # provide load_from_disk(), reset(), flush(), watermark and
+        # add(offs, rec). Returns the (single) instance for this worm.
+        ndx = self._attached.get(fname)
+        if ndx is None:
+            ndx = cls(os.path.join(self._logDname, fname),
+                      readonly=self._readonly)
+            ndx.load_from_disk()
+            self._checkWatermark(ndx)
+            self._attached[fname] = ndx
+            self._indexes.append( (ndx, ndx.add) )
+            self._catchup()
+        return ndx
+
+    def _checkWatermark(self, ndx):
+        # an index beyond the end of the log refers to entries which are
+        # gone (e.g. the log lost its unsynced tail in a crash): rebuild it
+        if ndx.watermark > self._log.size:
+            ndx.reset()
+
+    def _load_indexes(self):
+        for ndx,_ in self._indexes:
+            ndx.load_from_disk()
+            self._checkWatermark(ndx)
+        if self._keysHT.legacy:
+            # older keys.ht format: add the key fingerprints
+            self.compact()
+        self._catchup()
+
+    def _catchup(self):
+        # feed each index with the log entries beyond its watermark, in
+        # one forward pass: each record is read (and parsed) only once
+        todo = [ (ndx, fct) for ndx, fct in self._indexes
+                                           if ndx.watermark < self._log.size ]
+        if len(todo) == 0:
+            return
+        start = min([ndx.watermark for ndx,_ in todo])
+        total = self._log.size - start
+        step = max(total // 100, 1)
+        mark = start + step
+        end = start
+        for offs, m in self._log.records(start):
+            end = offs + len(m) + 12
+            m = SSB_WORM_RECORD(m)
+            for ndx, fct in todo:
+                if offs >= ndx.watermark:
+                    fct(offs, m)
+            if offs >= mark:
+                self._progress(offs - start, total)
+                mark = offs + step
+        for ndx,_ in todo:
+            ndx.advance(max(end, ndx.watermark))
+        self._progress(total, total)
 
     def __iter__(self):
+        # iterate over the msg keys, youngest entry first
         return SSB_WORM_ITER(self)
 
+    def records(self):
+        # iterate over SSB_WORM_RECORD views, youngest entry first
+        return SSB_WORM_ITER(self, records=True)
+
     def _getMaxSeq(self, id=None):
         if not id:
             id = self.id
-        if not id in self._last['value']:
+        if not id in self._last.value:
             return (None, 0)
-        r = self._last['value'][id]
+        r = self._last.value[id]
         return (r['id'], r['sequence'])
 
-        # search the log backwards for this author's newest message
-        # id = self._key.id
-        self._log.seek(0, os.SEEK_END)
-        if self._log.tell() != 0:
-            self._log.seek(-4, os.SEEK_END)
-            while True:
-                self._log.seek(-4, os.SEEK_CUR)
-                sz = _readUInt32BE(self._log)
-                self._log.seek(-4 - sz, os.SEEK_CUR)
-                msg = self._log.read(sz)
-                if msg is None:
-                    break
-                msg = json.loads(msg.decode('utf8'))
-                if msg['value']['author'] == id:
-                    return (msg['key'], msg['value']['sequence'])
-                self._log.seek(-8 - sz, os.SEEK_CUR)
-        return (None, 0)
-
     def _updateMaxSeq(self, id, key, seq):
         ts = 0
-        self._last['value'][id] = {
+        self._last.value[id] = {
             'sequence': seq,
             'id':  key,
             'ts': ts
         }
+        self._last.touch()
 
     def _fetchMsgAt(self, pos): # absolute byte position into the log
         # returns the log entry as a Python dict, or None
-        self._log.seek(pos, os.SEEK_SET)
-        sz = _readUInt32BE(self._log)
-        msg = self._log.read(sz)
+        msg = self._log.record(pos)
         if not msg:
             return None
-        return json.loads(msg)
+        return json.loads(bytes(msg))
 
     def notify_on_extend(self, fct):
         # call this fct if the owner of this worm's log appends a msg
@@ -322,101 +1226,171 @@ class SSB_WORM:
     # ------------------------------------------------------------
 
     def blobAvailable(self, key):
-        key = id2bytes(key).hex()
-        return os.path.isfile(os.path.join(self._blobDname, key[:2], key[2:]))
+        return self._blobs.has(id2bytes(key).hex())
         
     def readBlob(self, key):
-        key = id2bytes(key).hex()
-        with open(os.path.join(self._blobDname, key[:2], key[2:]), "rb") as f:
-            data = f.read()
-        return data
+        return b''.join(self.readBlobChunks(key))
+
+    def readBlobChunks(self, key, chunkSize=BLOB_CHUNK):
+        # iterate over the blob's content in chunks of at most chunkSize
+        hx = id2bytes(key).hex()
+        self._blobCache.touch(hx)
+        return self._blobs.chunks(hx, chunkSize)
+
+    def blobWriter(self, foreign=False):
+        # foreign: the blob was fetched from a peer, may be evicted
+        def done(hx, size):
+            self._blobCache.add(hx, size, foreign)
+            if self._blobCache.over():
+                self._blobCache.evict(self._blobs,
+                                      self.blobPins() if self.blobPins else set())
+        return SSB_WORM_BLOB_WRITER(self._blobs,
+                                    self._log.durability == 'fsync', done)
+
+    def writeBlobFrom(self, src, chunkSize=BLOB_CHUNK):
+        # src is a binary file-like object or an iterator over byte strings;
+        # returns (blob key, size)
+        if hasattr(src, 'read'):
+            src = iter(functools.partial(src.read, chunkSize), b'')
+        w = self.blobWriter()
+        try:
+            for data in src:
+                w.write(data)
+        except:
+            w.abort()
+            raise
+        return (w.commit(), w.size)
 
     def writeBlob(self, data):
-        h = hashlib.sha256(data).digest()
-        hx = h.hex()
-        os.makedirs(os.path.join(self._blobDname, hx[:2]), exist_ok=True)
-        fn = os.path.join(self._blobDname, hx[:2], hx[2:])
-        if not os.path.isfile(fn):
-            with open(fn, "wb") as f:
-                f.write(data)
-        return '&' + base64.b64encode(h).decode('ascii')
+        return self.writeBlobFrom([data])[0]
 
     # ------------------------------------------------------------
 
     def readMsg(self, key): # 256bit key in SSB representation
+        # returns the log entry as a Python dict, or None. The dict may be
+        # shared with other callers (LRU cache): don't modify it.
+        e = self._cache.get(key)
+        if e:
+            self._cache.move_to_end(key)
+            self.cacheHits += 1
+            return e[0]
+        self.cacheMisses += 1
+        if not self._bloom.mightContain(key):
+            return None
         for offs in self._keysHT.offsets(key):
-            msg = self._fetchMsgAt(offs)
-            if not msg or msg['key'] == key:
+            m = self._log.record(offs)
+            if not m:
+                return None
+            msg = json.loads(bytes(m))
+            if msg['key'] == key:
+                self._cacheAdd(key, msg, len(m))
                 return msg
         return None
 
-    def getMsgBySequence(self, auth, seq):
-        for offs in self._seqsHT.offsets(_seq2key(auth, seq)):
-            msg = self._fetchMsgAt(offs)
-            if not msg:
-                return msg
-            val = msg['value']
-            if val['author'] == auth and val['sequence'] == seq:
-                return msg
+    def _cacheAdd(self, key, msg, size):
+        if size > self._cacheMaxBytes:
+            return
+        self._cache[key] = (msg, size)
+        self._cacheBytes += size
+        while len(self._cache) > self._cacheMaxEntries or \
+                                      self._cacheBytes > self._cacheMaxBytes:
+            _, (_, sz) = self._cache.popitem(last=False)
+            self._cacheBytes -= sz
+
+    def _cacheClear(self):
+        self._cache = collections.OrderedDict()
+        self._cacheBytes = 0
+
+    def cacheStats(self):
+        return { 'entries': len(self._cache), 'bytes': self._cacheBytes,
+                 'hits': self.cacheHits, 'misses': self.cacheMisses }
+
+    def offsetOf(self, key):
+        # returns the log position of the msg with this key, or None
+        if not self._bloom.mightContain(key):
+            return None
+        for offs in self._keysHT.offsets(key):
+            m = self._log.record(offs)
+            if not m:
+                return None
+            if SSB_WORM_RECORD(m).key == key:
+                return offs
         return None
 
+    def getMsgBySequence(self, auth, seq):
+        offs = self._seqs.offset(auth, seq)
+        if offs is None:
+            return None
+        m = self._log.record(offs)
+        if not m:
+            return None
+        rec = SSB_WORM_RECORD(m)
+        if rec.author != auth or rec.sequence != seq: # stale index entry
+            return None
+        return rec.msg
+
     # ------------------------------------------------------------
         
     def appendToLog(self, msgStr): # signed msg as a formatted str
         # returns id
-
-        # validate the msg before storing:
-        jmsg = json.loads(msgStr)
-        if not 'author' in jmsg or not 'signature' in jmsg:
-            raise ValueError
-        s = base64.b64decode( jmsg['signature'] )
-        i = msgStr.find(',\n  "signature":')
-        m = (msgStr[:i] + '\n}').encode('utf8')
-        # m = (msgStr[:i] + '\n}').encode('ascii')
-        if not verify_signature(jmsg['author'], m, s):
-            print("  invalid signature")
-            return None
-        # print("it verified!")
-
-        # compute id
-        h = hashlib.sha256(msgStr.encode('utf8')).digest()
-        id = '%' + base64.b64encode(h).decode('ascii') + '.sha256'
-
-        # check that this id is not stored yet
-        if self.readMsg(id) != None:
-            print("msg %s (%d) already exists" % (id, jmsg['sequence']))
-            return id
-
-        # format for storing the entry in the 'log.offset' file
-        logStr = '\n  '.join(msgStr.split('\n'))
-        logStr = '{\n  "key": "%s",\n  "value": ' % id + logStr + \
-                 ',\n  "timestamp": %d\n}' % int(time.time()*1000)
-        logStr = logStr.encode('utf8')
-
-        if self._readonly:
-            return id
+        return self.appendMany([msgStr])[0]
+
+    def appendMany(self, msgStrs, verified=None):
+        # msgStrs is a list of signed msgs as formatted strs, verified
+        # optionally is the list of signature check results (SSB_VERIFIER)
+        # returns the list of ids (None for msgs that did not validate),
+        # the whole batch is written to the log in one go
+        if verified is None:
+            verified = _check_signatures(msgStrs)
+        ids = []
+        batch = [] # (id, jmsg, logStr)
+        fresh = set()
+        for msgStr, ok in zip(msgStrs, verified):
+            # validate the msg before storing:
+            jmsg = json.loads(msgStr)
+            if not 'author' in jmsg or not 'signature' in jmsg:
+                raise ValueError
+            if not ok:
+                print("  invalid signature")
+                ids.append(None)
+                continue
+            # print("it verified!")
+
+            # compute id
+            h = hashlib.sha256(msgStr.encode('utf8')).digest()
+            id = '%' + base64.b64encode(h).decode('ascii') + '.sha256'
+            ids.append(id)
+
+            # check that this id is not stored yet
+            if id in fresh or self.readMsg(id) != None:
+                print("msg %s (%d) already exists" % (id, jmsg['sequence']))
+                continue
+
+            # format for storing the entry in the 'log.offset' file
+            logStr = '\n  '.join(msgStr.split('\n'))
+            logStr = '{\n  "key": "%s",\n  "value": ' % id + logStr + \
+                     ',\n  "timestamp": %d\n}' % int(time.time()*1000)
+            batch.append( (id, jmsg, logStr.encode('utf8')) )
+            fresh.add(id)
+
+        if self._readonly or len(batch) == 0:
+            return ids
 
         # append to the log
-        self._log.close()
-        self._log = open(self._logFname, 'r+b')
-
-        self._log.seek(0, os.SEEK_END)
-        offs = self._log.tell()
-        sz = len(logStr).to_bytes(4, byteorder='big')
-        self._log.write(sz)
-        self._log.write(logStr)
-        self._log.write(sz)
-        pos = self._log.tell() + 4
-        _writeUInt32BE(self._log, pos)
-        self._log.flush()
+        offsets = self._log.appendMany([e[2] for e in batch])
 
-        self._keysHT.add(id, offs)
-        self._seqsHT.add(_seq2key(jmsg['author'], jmsg['sequence']), offs)
+        recs = [ SSB_WORM_RECORD(e[2]) for e in batch ]
+        for ndx, fct in self._indexes:
+            for offs, rec in zip(offsets, recs):
+                fct(offs, rec)
+            ndx.advance(self._log.size)
 
-        if self._on_extend and jmsg['author'] == self.id:
-            self._on_extend(json.loads(logStr))
+        if self._on_extend:
+            for id, jmsg, logStr in batch:
+                if jmsg['author'] == self.id:
+                    self._on_extend(json.loads(logStr))
 
-        return id
+        return ids
 
     def writeMsg(self, msg): # msg is a Python dict or string
         # returns the new msg id
@@ -446,52 +1420,68 @@ class SSB_WORM:
 
     # ------------------------------------------------------------
 
+    def _keyAt(self, offs):
+        return SSB_WORM_RECORD(self._log.record(offs)).key
+
+    def compact(self):
+        # rehash the keys index into one table, and rebuild the Bloom
+        # filter chain as one filter with room for as many keys again
+        cap = 64*1024
+        while cap < 2*self._keysHT._count:
+            cap *= 2
+        self._bloom.reset(cap)
+        def keyAt(offs):
+            key = self._keyAt(offs)
+            self._bloom.add(key)
+            return key
+        self._keysHT.compact(keyAt)
+        self._bloom.advance(self._keysHT.watermark)
+
     def flush(self):
         if self._readonly:
             return
-        self._keysHT.flush()
-        self._seqsHT.flush()
-        with open(self._lastFname, "w") as f:
-            json.dump(self._last, f)
+        self._log.sync()
+        if len(self._keysHT._ndxTables) > COMPACT_TABLES or \
+                               len(self._bloom._filters) > COMPACT_FILTERS:
+            self.compact()
+        for ndx,_ in self._indexes:
+            ndx.flush()
+        self._blobCache.flush()
 
     def refresh(self):
-        if self._keysHT._ndxDirty or self._seqsHT._ndxDirty:
-            print("warning, disregarding changed ndx information")
-        self._log.close()
-        self._log = open(self._logFname, 'rb' if self._readonly else 'r+b')
-
-        self._keysHT.load_from_disk()
-        self._seqsHT.load_from_disk()
-        with open(self._lastFname, "rb") as f:
-            self._last = json.load(f)
+        # pick up log entries appended by others: the in-memory indexes
+        # are at least as recent as the files, catching up is enough
+        size = self._log.size
+        self._log.remap()
+        if self._log.size < size: # log was replaced, start over
+            self._cacheClear()
+            self._load_indexes()
+        else:
+            self._catchup()
 
         
 class SSB_WORM_ITER():
 
-    def __init__(self, worm):
-        # return log content BACKWARDS (youngest entry first)
+    def __init__(self, worm, records=False):
+        # return log content BACKWARDS (youngest entry first), as keys
+        # or as SSB_WORM_RECORD views
         self._worm = worm
+        self._records = records
         self._log = worm._log
-        self._log.seek(0, os.SEEK_END)
-        self._pos = self._log.tell()
-        if self._pos > 0:
-            self._log.seek(-4, os.SEEK_END)
-            self._pos = self._log.tell() # at end of a chunk (and its size)
+        self._pos = self._log.size # at end of a chunk (and its trailer)
 
     def __iter__(self):
         return self
 
     def __next__(self):
         # print("worm iter next", self._pos)
-        if self._pos < 4:
+        if self._pos is None:
+            raise StopIteration
+        self._pos, m = self._log.recordBefore(self._pos)
+        if m is None:
             raise StopIteration
-        self._log.seek(self._pos - 4, os.SEEK_SET)
-        sz = _readUInt32BE(self._log)
-        self._log.seek(-4 - sz, os.SEEK_CUR)
-        m = self._log.read(sz)
-        self._pos -= sz + 12
-        m = json.loads(m)
-        return m['key']
+        m = SSB_WORM_RECORD(m)
+        return m if self._records else m.key
 
 # ----------------------------------------------------------------------
 
@@ -8,7 +8,6 @@
 
 from asyncio import get_event_loop, gather, ensure_future
 import base64
-import hashlib
 import inspect
 import json
 import os
@@ -39,6 +38,7 @@ class SSB_SESSION():
         self.id = self.secr.id
         self.peer_id = ssb.local.config.SSB_SECRET(None).id
         self.worm = ssb.local.worm.SSB_WORM(username, self.secr)
+        self.verifier = ssb.local.worm.SSB_VERIFIER()
 
 # ---------------------------------------------------------------------------
 
@@ -81,16 +81,16 @@ def blobs_createWants(connection, req_msg, sess=None):
 def blobs_get(connection, req_msg, sess=None):
     a = req_msg.body['args'][0]
     logger.info('RECV [%d] blobs.get %s', req_msg.req, a)
-    # while True: chunk the data etc
     if sess.worm.blobAvailable(a):
-        data = sess.worm.readBlob(a)
-        if data:
-            connection.send(data,
+        try:
+            for data in sess.worm.readBlobChunks(a):
+                connection.send(data,
                             msg_type=ssb.rpc.packet_stream.PSMessageType.BUFFER,
                             req= - req_msg.req)
             connection.send(True, end_err= True, req= - req_msg.req)
             return
-        err = "local error"
+        except OSError:
+            err = "local error"
     else:
         err = "no such blob"
     connection.send({ 'name': 'Error', 'message': err },
@@ -99,37 +99,71 @@ def blobs_get(connection, req_msg, sess=None):
 
 async def fetch_blob(sess, id):
     logger.info('me fetching blob %s', id)
-    data = bytes(0)
-    async for msg in api.call('blobs.get', [id], 'source'):
-        chunk = msg.data
-        logger.debug('RESP: %d (%d bytes)', msg.req, len(chunk))
-        if not msg.end_err:
-            data += chunk
-    nm = hashlib.sha256(data).digest()
-    nm = '&' + base64.b64encode(nm).decode('ascii')
-    if nm == id:
-        sess.worm.writeBlob(data)
+    w = sess.worm.blobWriter(foreign=True)
+    try:
+        async for msg in api.call('blobs.get', [id], 'source'):
+            chunk = msg.data
+            logger.debug('RESP: %d (%d bytes)', msg.req, len(chunk))
+            if not msg.end_err:
+                w.write(chunk)
+    except:
+        w.abort()
+        raise
+    if w.key == id:
+        w.commit()
     else:
-        logger.info('fetchBlob: mismatch %s (%d bytes)', nm, len(data))
-
+        logger.info('fetchBlob: mismatch %s (%d bytes)', w.key, w.size)
+        w.abort()
+
+
+MAX_BATCH = 500 # max number of received msgs appended to the log in one go
+
+async def _append_batch(sess, batch, verifying):
+    # batch is a list of (jmsg, raw msg data, author) tuples, verifying the
+    # future of its signature checks. Once a msg of an author fails, the
+    # author's later msgs in the batch are dropped too (no holes in a feed).
+    # Returns the set of authors with a msg that was not appended
+    ok = list(await verifying)
+    first = {} # author -> index of the first msg that failed
+    for i, e in enumerate(batch):
+        if e[2] in first:
+            ok[i] = False
+        elif not ok[i]:
+            first[e[2]] = i
+    keys = sess.worm.appendMany([e[0] for e in batch], ok)
+    for i, (key, (jmsg, data, a)) in enumerate(zip(keys, batch)):
+        if not key and first.setdefault(a, i) == i:
+            print("appendToLog failed, invalid signature?")
+            print(data)
+            print(jmsg)
+    return set(first)
+
+def _verify(sess, batch):
+    return ensure_future(sess.verifier.verify_async([e[0] for e in batch]))
 
 async def request_log_feed(sess, id, seq, end_after_sync=False):
     logger.info('me requesting feed %s / %d..', id, seq)
-    async for msg in api.call('createHistoryStream', [{
+    src = api.call('createHistoryStream', [{
         'id': id,
         'seq': seq,
         # 'live': False,
         'live': not end_after_sync,
         'keys': False
-    }], 'source'):
+    }], 'source')
+    batch = []
+    pending = None # (batch, future) whose signatures are being checked
+    expected = {} # author -> next sequence number, incl. batched msgs
+    async for msg in src:
         logger.debug('RESPONSE: %d', msg.req)
         # print(type(msg.body))
         # print(msg.body)
         d = json.loads(msg.data)
         if type(d) == dict:
-            _, seq = sess.worm._getMaxSeq(d['author'])
-            if seq+1 != d['sequence']:
-                print('seq gap:', d['sequence'], 'instead of', seq+1)
+            a = d['author']
+            if not a in expected:
+                expected[a] = sess.worm._getMaxSeq(a)[1] + 1
+            if expected[a] != d['sequence']:
+                print('seq gap:', d['sequence'], 'instead of', expected[a])
             else:
                 logger.debug('* seq %s / %d', d['author'], d['sequence'])
                 jmsg = ssb.local.worm.formatMsg(d['previous'] if 'previous' in d else None,
@@ -137,22 +171,46 @@ async def request_log_feed(sess, id, seq, end_after_sync=False):
                                                 d['timestamp'], d['hash'],
                                                 d['content'], d['signature'])
                 # print(jmsg)
-                key = sess.worm.appendToLog(jmsg)
-                if key:
-                    # sess.last.set_last_seq(d['author'], seq+1, key)
-                    sess.worm._updateMaxSeq(d['author'], key, seq+1)
-                else:
-                    print("appendToLog failed, invalid signature?")
-                    print(msg.data)
-                    print(jmsg)
-                    if 'text' in d['content']:
-                        print(type(d['content']['text']))
-                        print(d['content']['text'])
+                batch.append( (jmsg, msg.data, a) )
+                expected[a] += 1
         elif d == True:
             logger.info("end of worm updating")
-            sess.worm.flush()
         else:
             logger.debug("%s", str(msg))
+        # group commit: append when the batch is full or when no further
+        # msg is already waiting in the stream's queue. While more msgs are
+        # queued, the signatures of a batch are checked in the background
+        # as the next one fills; an idle stream leaves nothing pending.
+        idle = not src.queued()
+        if len(batch) > 0 and (len(batch) >= MAX_BATCH or idle):
+            if pending:
+                failed = await _append_batch(sess, *pending)
+                pending = None
+                if failed: # re-read from the log, drop what can't follow
+                    batch = [ e for e in batch if not e[2] in failed ]
+                    for a in failed:
+                        expected.pop(a, None)
+            if len(batch) > 0:
+                if idle:
+                    for a in await _append_batch(sess, batch,
+                                                 _verify(sess, batch)):
+                        expected.pop(a, None)
+                else:
+                    pending = (batch, _verify(sess, batch))
+            batch = []
+        if d == True:
+            if pending:
+                failed = await _append_batch(sess, *pending)
+                pending = None
+                batch = [ e for e in batch if not e[2] in failed ]
+                for a in failed:
+                    expected.pop(a, None)
+            sess.worm.flush()
+    if pending:
+        failed = await _append_batch(sess, *pending)
+        batch = [ e for e in batch if not e[2] in failed ]
+    if len(batch) > 0:
+        await _append_batch(sess, batch, _verify(sess, batch))
 
 # ---------------------------------------------------------------------------
 
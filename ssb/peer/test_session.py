@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# ssb/peer/test_session.py
+
+import asyncio
+import json
+import os
+import types
+
+import pytest
+
+import ssb.local.config
+import ssb.local.worm
+import ssb.peer.session
+
+# ---------------------------------------------------------------------------
+
+def _user(name):
+    d = os.path.join(os.path.expanduser('~/.ssb'), 'user.' + name)
+    os.makedirs(d)
+    ssb.local.config.create_new_user_secret(os.path.join(d, 'secret'))
+    secr = ssb.local.config.SSB_SECRET(name)
+    return ssb.local.worm.SSB_WORM(name, secr, durability='none')
+
+@pytest.fixture()
+def feed(tmp_path, monkeypatch):
+    # Alice's first five msgs, as createHistoryStream sends them
+    monkeypatch.setenv('HOME', str(tmp_path))
+    w = _user('Alice')
+    for i in range(5):
+        w.writeMsg({ 'type': 'post', 'text': 'msg %d' % i })
+    return [ w.getMsgBySequence(w.id, i+1)['value'] for i in range(5) ]
+
+@pytest.fixture()
+def sess(feed):
+    # the receiving side
+    return types.SimpleNamespace(worm=_user('Bob'),
+                                 verifier=ssb.local.worm.SSB_VERIFIER())
+
+def _bad(msg):
+    msg = dict(msg)
+    s = msg['signature']
+    msg['signature'] = ('B' if s[0] == 'A' else 'A') + s[1:]
+    return msg
+
+def _seqs(sess, feed):
+    a = feed[0]['author']
+    return [ i for i in range(1, 8) if sess.worm.getMsgBySequence(a, i) ]
+
+class _MSG:
+    def __init__(self, d):
+        self.data = json.dumps(d).encode('utf8')
+        self.req = 1
+
+class _SOURCE:
+
+    # stands in for the muxrpc source handler of createHistoryStream
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def queued(self):
+        return not self.queue.empty()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        m = await self.queue.get()
+        if m is None:
+            raise StopAsyncIteration
+        return m
+
+def _request(sess, feed, msgs, monkeypatch, batch=500):
+    # stream msgs into request_log_feed (live mode), returns the seqs in
+    # the log while the stream is idle and after it ended
+    src = _SOURCE()
+    monkeypatch.setattr(ssb.peer.session, 'api',
+                        types.SimpleNamespace(call=lambda *args: src))
+    monkeypatch.setattr(ssb.peer.session, 'MAX_BATCH', batch)
+    async def run():
+        t = asyncio.ensure_future(ssb.peer.session.request_log_feed(sess,
+                                                 feed[0]['author'], 1))
+        for m in msgs:
+            src.queue.put_nowait(_MSG(m))
+        for i in range(20):
+            await asyncio.sleep(0.01)
+        idle = _seqs(sess, feed)
+        src.queue.put_nowait(None)
+        await t
+        return idle
+    idle = asyncio.run(run())
+    return (idle, _seqs(sess, feed))
+
+@pytest.mark.parametrize('batch', [500, 2])
+def test_live_idle(sess, feed, monkeypatch, batch):
+    # an idle stream leaves no batch pending
+    assert _request(sess, feed, feed[:3], monkeypatch,
+                    batch) == ([1, 2, 3], [1, 2, 3])
+
+def test_append_batch_masks_author(sess, feed):
+    # after a bad signature, the author's later msgs are dropped as well
+    msgs = feed[:2] + [_bad(feed[2])] + feed[3:]
+    batch = [ (ssb.local.worm.formatMsg(m['previous'], m['sequence'],
+                                        m['author'], m['timestamp'],
+                                        m['hash'], m['content'],
+                                        m['signature']), b'', m['author'])
+                                                               for m in msgs ]
+    async def run():
+        return await ssb.peer.session._append_batch(sess, batch,
+                                        ssb.peer.session._verify(sess, batch))
+    assert asyncio.run(run()) == set([feed[0]['author']])
+    assert _seqs(sess, feed) == [1, 2]
+
+@pytest.mark.parametrize('batch', [500, 2])
+def test_bad_signature(sess, feed, monkeypatch, batch):
+    # no holes in the feed, a resend continues after the last good msg
+    msgs = feed[:2] + [_bad(feed[2])] + feed[3:]
+    assert _request(sess, feed, msgs, monkeypatch, batch)[1] == [1, 2]
+    assert _request(sess, feed, feed[2:], monkeypatch,
+                    batch)[1] == [1, 2, 3, 4, 5]
+
+# eof
@@ -35,6 +35,9 @@ class MuxRPCSourceHandler(MuxRPCHandler):
     def __init__(self, ps_handler):
         self.ps_handler = ps_handler
 
+    def queued(self):
+        return self.ps_handler.queued()
+
     @async_generator
     async def __aiter__(self):
         async for msg in self.ps_handler:
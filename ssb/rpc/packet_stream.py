@@ -36,6 +36,10 @@ class PSStreamHandler(object):
     async def stop(self):
         await self.queue.put(None)
 
+    def queued(self):
+        # True if received messages are waiting to be read
+        return not self.queue.empty()
+
     @async_generator
     async def __aiter__(self):
         while True: